@@ -21,6 +21,8 @@ classes:
     carouselCalibrationData  object to load and store the calibration data
     fitData  object with methods and data related to the fitting process
 
+Attenuation data for materials is shared through a process wide registry,
+see getMaterialAtt.
 """
 # just for reading 16 bit images and conversion to log(I0/I)
 from __future__ import division
@@ -29,6 +31,9 @@ from __future__ import print_function
 import sys
 import os
 import logging
+import timeit
+import hashlib
+import tempfile
 import pdb
 try:
     import numpy as np
@@ -38,6 +43,12 @@ try:
     import matplotlib.pyplot as plt
 except ImportError:
     sys.exit("Error: cant find matplotlib")
+# numba is optional; it is only used by the compiled forward model, see fitData.engine
+try:
+    from numba import njit, prange
+    haveNumba = True
+except ImportError:
+    haveNumba = False
 
 
 class specData(object):
@@ -142,12 +153,13 @@ class materialAtt(object):
 
     def readFile(self, formula, density):
         """ load the mu data for this material from a simple ascii file in ./xcom
-             mu is mulitplied by density """
+             mu is mulitplied by density. The arrays are shared so are read only."""
         filename = "./xcom/%s.txt" % (formula)
         if os.path.isfile(filename):
-            with open(filename, 'r') as fl:
-                self.energy, self.mu = np.loadtxt(fl, unpack=True)
-                self.mu = self.mu*density
+            table = readXcomTable(filename)
+            self.energy = table[0]
+            self.mu = table[1]*density
+            self.mu.flags.writeable = False
             self.valid = True
         else:
             print("failed to find attenuation file: ", filename)
@@ -170,25 +182,411 @@ class materialAtt(object):
         return self.energy[-1]
 
     def getMuByE(self,energyVal):
-        """ return attenuation for the given energy """
-        if energyVal<0:
-            print("error: bad value in getMuByE")
-            return -1.
-        for i in range(len(self.energy)):
-            if energyVal <= self.energy[i]:
-                if energyVal == self.energy[i]:
-                    return self.mu[i]
-                else:
-                    frac = (energyVal-self.energy[i-1])/(self.energy[i]-self.energy[i-1])
-                    muVal = self.mu[i-1]+(self.mu[i]-self.mu[i-1])*frac
-                    return muVal
-        print("error: failed to match energy in getMuByE")
-        return -1.
+        """ return attenuation for the given energy, or array of energies, by
+            linear interpolation in the table. Raises ValueError if any energy
+            is outside the range of the table. """
+        energies = np.asarray(energyVal, dtype=float)
+        if np.any(np.isnan(energies)) or np.any(energies < self.energy[0]) or \
+           np.any(energies > self.energy[-1]):
+            raise ValueError("energy outside range %g to %g KeV for %s in getMuByE" %
+                             (self.energy[0], self.energy[-1], self.name))
+        muVal = np.interp(energies, self.energy, self.mu)
+        if muVal.ndim == 0:
+            return float(muVal)
+        return muVal
 
     def isValid(self):
         """ if object ok"""
         return self.valid
 
+# Parsed xcom tables keyed by file name, each held as (mtime, table) where table
+# is a contiguous (2 x energies) array of energy and mu.
+_xcomTables = {}
+# materialAtt objects keyed by (formula, density), held as (mtime, material)
+_materialRegistry = {}
+
+def readXcomTable(filename):
+    """ Return the (2 x energies) array of energy and mu from an xcom text file.
+        Each file is parsed once per process. A binary copy is kept in a .npy
+        file beside the text file and used in place of parsing the text while it
+        is newer than the text file.
+    """
+    mtime = os.path.getmtime(filename)
+    if filename in _xcomTables and _xcomTables[filename][0] == mtime:
+        return _xcomTables[filename][1]
+    npyfile = os.path.splitext(filename)[0]+".npy"
+    table = None
+    if os.path.isfile(npyfile) and os.path.getmtime(npyfile) >= mtime:
+        try:
+            table = np.load(npyfile)
+        except (IOError, OSError, ValueError):
+            logging.warning('failed to read cache file %s', npyfile)
+    if table is None:
+        with open(filename, 'r') as fl:
+            table = np.loadtxt(fl, unpack=True)
+        try:
+            np.save(npyfile, table)
+        except (IOError, OSError):
+            logging.info('could not write cache file %s', npyfile)
+    table = np.ascontiguousarray(table, dtype=float)
+    table.flags.writeable = False
+    _xcomTables[filename] = (mtime, table)
+    return table
+
+def getMaterialAtt(formula, density):
+    """ Return the shared materialAtt object for formula at the given density,
+        creating it on first use. Objects that fail to load are not kept, so
+        the file is looked for again on the next call.
+    """
+    key = (formula, float(density))
+    filename = "./xcom/%s.txt" % (formula)
+    if not os.path.isfile(filename):
+        return materialAtt(formula, density)
+    mtime = os.path.getmtime(filename)
+    if key in _materialRegistry and _materialRegistry[key][0] == mtime:
+        return _materialRegistry[key][1]
+    mat = materialAtt(formula, density)
+    if mat.isValid():
+        _materialRegistry[key] = (mtime, mat)
+    return mat
+
+def muMatrix(materials, nen, energies=None):
+    """ Return the stacked (materials x energies) matrix of mu for a list of
+        materialAtt objects, truncated to the first nen energies. If an array
+        of energies is given mu is instead interpolated to those energies.
+    """
+    mumat = np.zeros((len(materials), nen))
+    for i, mat in enumerate(materials):
+        if energies is None:
+            mumat[i, :] = mat.getMu()[:nen]
+        else:
+            mumat[i, :] = mat.getMuByE(energies)
+    return mumat
+
+def reduceEnergyGrid(xe, spec, minpt, nbins, breaks=()):
+    """ Map the uniform energy grid xe onto about nbins contiguous bins, for a
+        faster approximate sum over energy. Bins are chosen to hold similar
+        weight of the source spectrum spec (mixed with 20% uniform weight, or
+        uniform if spec is None); the points below minpt, which are dropped from
+        the fit, are binned separately. A bin also starts at each index in
+        breaks, e.g. at absorption edges of the materials. Returns the node energy of each bin (the
+        spectrum weighted mean), the number of points in each bin, the mean
+        spectrum in each bin (None if spec is None) and the index of the first
+        node at or above minpt.
+    """
+    n = len(xe)
+    if spec is None:
+        wt = np.ones(n)
+    else:
+        wt = np.maximum(spec, 0.)
+        wt = 0.8*wt/max(np.sum(wt), 1.e-300)+0.2/n
+    # share the bins between the two ranges by weight, at least one each
+    nlow = 0
+    if minpt > 0:
+        nlow = max(1, int(round(nbins*np.sum(wt[:minpt])/np.sum(wt))))
+    edges = [0]
+    for start, end, nb in ((0, minpt, nlow), (minpt, n, max(1, nbins-nlow))):
+        if end <= start:
+            continue
+        cum = np.cumsum(wt[start:end])
+        cut = np.searchsorted(cum, cum[-1]*np.arange(1, nb)/nb)+1
+        edges.extend(np.unique(start+cut[cut < end-start]))
+        edges.append(end)
+    edges = np.unique(np.concatenate((edges, [b for b in breaks if 0 < b < n])).astype(int))
+    counts = np.diff(edges).astype("double")
+    starts = edges[:-1]
+    if spec is None:
+        nodes = np.add.reduceat(xe, starts)/counts
+        specNode = None
+    else:
+        ssum = np.add.reduceat(spec, starts)
+        esum = np.add.reduceat(spec*xe, starts)
+        mean = np.add.reduceat(xe, starts)/counts
+        nodes = np.where(ssum > 0., esum/np.where(ssum > 0., ssum, 1.), mean)
+        specNode = ssum/counts
+    return nodes, counts, specNode, int(np.searchsorted(edges, minpt))
+
+def batchPolyFit(x, y, deg):
+    """ Least squares fit of a polynomial of order deg to each row of x and y,
+        equivalent to calling np.polyfit on every row but solved for all rows
+        together by SVD of the stacked, column scaled, Vandermonde matrices.
+        Rows containing non-finite values are not fitted.
+        Returns the coefficients (rows x deg+1, highest power first), the
+        residual sum of squares and the condition number of each row, with
+        nan for rows not fitted.
+    """
+    x = np.atleast_2d(x)
+    y = np.atleast_2d(y)
+    nrows, npts = x.shape
+    coeffs = np.zeros((nrows, deg+1))
+    resid = np.full(nrows, np.nan)
+    cond = np.full(nrows, np.nan)
+    good = np.all(np.isfinite(x), axis=1) & np.all(np.isfinite(y), axis=1)
+    if not np.any(good):
+        return coeffs, resid, cond
+    xg = x[good]
+    yg = y[good]
+    vander = xg[:, :, np.newaxis]**np.arange(deg, -1, -1)
+    # scale columns to improve conditioning, as np.polyfit
+    scale = np.sqrt(np.sum(vander*vander, axis=1))
+    scale[scale == 0.] = 1.
+    vander = vander/scale[:, np.newaxis, :]
+    u, sv, vt = np.linalg.svd(vander, full_matrices=False)
+    rcond = npts*np.finfo(float).eps
+    small = sv <= rcond*sv[:, :1]
+    svinv = np.where(small, 0., 1./np.where(small, 1., sv))
+    uty = np.einsum('rik,ri->rk', u, yg)
+    cscaled = np.einsum('rkj,rk->rj', vt, svinv*uty)
+    resid[good] = np.sum((yg-np.einsum('rij,rj->ri', vander, cscaled))**2, axis=1)
+    cond[good] = sv[:, 0]/sv[:, -1]
+    coeffs[good] = cscaled/scale
+    return coeffs, resid, cond
+
+if haveNumba:
+    @njit(parallel=True)
+    def _forwardKernel(tw, dw, fw, ec, se, muTarget, muDetector, muFilter, attFixed,
+                       trans, minpt, resp, i0, isample):
+        """ compiled forward model: fills the nan free (lines x energies) response
+            resp, the sum i0 of each line and the (lines x points) sums isample of the
+            response times the transmission trans, summing energies from minpt.
+            Each line is done in one pass without temporary arrays; lines in parallel.
+            """
+        nlines, nen = resp.shape
+        npoints = trans.shape[0]
+        for l in prange(nlines):
+            s0 = 0.
+            for e in range(nen):
+                v = se[e]*np.exp(-attFixed[e]-fw[l]*muFilter[e]-tw[l]*muTarget[e])*ec[e]* \
+                    (1.-np.exp(-dw[l]*muDetector[e]))
+                # exp overflow gives inf, multiply by 0 gives nan; these are ignored
+                if np.isnan(v):
+                    v = 0.
+                resp[l, e] = v
+                if e >= minpt:
+                    s0 += v
+            i0[l] = s0
+            for k in range(npoints):
+                acc = 0.
+                for e in range(minpt, nen):
+                    acc += resp[l, e]*trans[k, e]
+                isample[l, k] = acc
+
+
+# version of the layout of the saved derived image data, see carouselCalibrationData
+SIDECAR_VERSION = 2
+
+
+def fileHash(filename, blockSize=1<<20):
+    """ Return the md5 hex digest of the contents of a file, read in blocks so
+        large image files are not held in memory. """
+    digest = hashlib.md5()
+    with open(filename, 'rb') as fl:
+        block = fl.read(blockSize)
+        while block:
+            digest.update(block)
+            block = fl.read(blockSize)
+    return digest.hexdigest()
+
+
+def readCheckpoint(filename):
+    """ Read a checkpoint written by fitData.writeCheckpoint. Returns a dict of
+        its values, with the input file hashes as dict "hashes". Raises IOError,
+        KeyError or ValueError if the file can not be read. """
+    with np.load(filename) as data:
+        ckpt = dict((key, data[key]) for key in data.files)
+    ckpt["hashes"] = dict(zip([str(n) for n in ckpt.pop("hashNames")],
+                              [str(h) for h in ckpt.pop("hashValues")]))
+    for key in ("x", "vary", "defaults", "mask", "nlines", "firstLine", "lineStep", "lineMode"):
+        if key not in ckpt:
+            raise KeyError(key)
+    return ckpt
+
+
+def logTransform(raw, whiteLevel, zeroOffset=0, fill=None, out=None, dtype="float64"):
+    """ Return log(whiteLevel/raw) for the stack of uint16 images raw (images x lines
+        x rows), and an array of the number of zero pixels in each image. Zeros are
+        replaced by fill[i] for image i or, if fill is None, by the mean of the image
+        plus zeroOffset, truncated to uint16. The result is put in out, if given, an
+        array of the same shape, or else a new array of type dtype. Single precision
+        results are rounded from the double precision values.
+    """
+    nimages = len(raw)
+    flat = raw.reshape(nimages, -1)
+    isZero = flat == 0
+    counts = np.count_nonzero(isZero, axis=1)
+    if fill is None:
+        fill = (flat.sum(axis=1, dtype=np.uint64)/flat.shape[1] + zeroOffset).astype(np.uint16)
+    if out is None:
+        out = np.empty(raw.shape, dtype=dtype)
+    with np.errstate(divide='ignore'):
+        if out.dtype == np.float64:
+            np.divide(whiteLevel, raw, out=out)
+            np.log(out, out=out)
+        else:
+            for i in range(nimages):
+                out[i] = np.log(whiteLevel / raw[i])
+    for i in np.nonzero(counts)[0]:
+        out[i][isZero[i].reshape(raw.shape[1:])] = np.log(whiteLevel / fill[i:i+1])
+    return out, counts
+
+
+def hashUpdate(digest, value):
+    """ Add value to a hashlib digest. value may be an array, a number or string,
+        a materialAtt object, or a list, tuple or dict of these. """
+    if isinstance(value, np.ndarray):
+        digest.update((str(value.dtype)+str(value.shape)).encode())
+        # in blocks, so that a memory mapped image is not read in all at once
+        flat = np.ascontiguousarray(value).reshape(-1)
+        for start in range(0, flat.size, 1048576):
+            digest.update(flat[start:start+1048576].tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(("seq"+str(len(value))).encode())
+        for item in value:
+            hashUpdate(digest, item)
+    elif isinstance(value, dict):
+        digest.update(("dict"+str(len(value))).encode())
+        for key in sorted(value):
+            hashUpdate(digest, key)
+            hashUpdate(digest, value[key])
+    elif isinstance(value, materialAtt):
+        hashUpdate(digest, (value.name, value.getE(), value.getMu()))
+    else:
+        digest.update(repr(value).encode())
+
+
+class resultCache(object):
+    """ On disk cache of fit results. Each entry is an .npz file in directory named
+        by the hash of all the inputs to the fit, see fitData.inputKey. Reading an
+        entry marks it as recently used; when the total size exceeds maxBytes the
+        least recently used entries are removed.
+    """
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def __path(self, key):
+        return os.path.join(self.directory, key+".npz")
+
+    def get(self, key):
+        """ return a dict of the arrays stored for key, or None if not cached """
+        path = self.__path(key)
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+        try:
+            with np.load(path) as data:
+                entry = dict((name, data[name]) for name in data.files)
+        except (IOError, OSError, ValueError):
+            print("** removing unreadable cache entry ", path)
+            os.remove(path)
+            self.misses += 1
+            return None
+        os.utime(path, None)
+        self.hits += 1
+        return entry
+
+    def put(self, key, **arrays):
+        """ store the arrays for key, then remove old entries if over size """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.__path(key)
+        tmpFile = path+".tmp.npz"
+        np.savez(tmpFile, **arrays)
+        getattr(os, "replace", os.rename)(tmpFile, path)
+        self.evict()
+
+    def entries(self):
+        """ list of (last used time, size, path) of the entries, oldest first """
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+                path = os.path.join(self.directory, name)
+                info = os.stat(path)
+                found.append((info.st_mtime, info.st_size, path))
+        return sorted(found)
+
+    def evict(self):
+        """ remove least recently used entries until within maxBytes """
+        found = self.entries()
+        total = sum(entry[1] for entry in found)
+        for mtime, size, path in found:
+            if total <= self.maxBytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        """ remove all entries; returns the number removed """
+        found = self.entries()
+        for mtime, size, path in found:
+            os.remove(path)
+        return len(found)
+
+    def stats(self):
+        """ return the number of entries, their total size in bytes, and the hits
+            and misses since this object was created """
+        found = self.entries()
+        return len(found), sum(entry[1] for entry in found), self.hits, self.misses
+
+
+def multiStartPoints(x0, index, nstart, spread, method="lhs", seed=None):
+    """ Return an array of starting points (points x len(x0)) around x0 for a
+        multi-start fit. Only the variables listed in index are changed, each
+        over x0 +/- spread*|x0| (or +/- spread if x0 is zero). method "lhs" gives
+        nstart Latin hypercube samples, the first of which is x0 itself; "grid"
+        gives a regular grid with about nstart**(1/len(index)) levels, at least
+        2, in each variable.
+    """
+    x0 = np.asarray(x0, dtype="double")
+    index = list(index)
+    delta = spread*np.where(x0[index] != 0., np.abs(x0[index]), 1.)
+    if method == "grid":
+        levels = max(2, int(round(nstart**(1./max(len(index), 1)))))
+        axes = [np.linspace(-1., 1., levels)]*len(index)
+        unit = np.array(np.meshgrid(*axes, indexing="ij")).reshape(len(index), -1).T
+    elif method == "lhs":
+        rng = np.random.RandomState(seed)
+        unit = np.zeros((nstart, len(index)))
+        for k in range(len(index)):
+            unit[:, k] = 2.*(rng.permutation(nstart)+rng.uniform(size=nstart))/nstart-1.
+        unit[0, :] = 0.
+    else:
+        raise ValueError("unknown multi-start method: "+str(method))
+    points = np.tile(x0, (len(unit), 1))
+    points[:, index] += unit*delta
+    return points
+
+# fitData object used by the worker processes of fitData.multiStartFit
+_startFitData = None
+
+def _initStartWorker(fit):
+    """ set the fitData object for a multi-start worker process """
+    global _startFitData
+    _startFitData = fit
+
+def _startFit(args):
+    """ run one fit of a multi-start set in a worker, discarding printed output.
+        Returns the fit solution, sum of squared errors over all lines, the
+        number of function evaluations and the solver status. """
+    xstart, nlines, lstep, firstLine = args
+    fit = _startFitData
+    stdout = sys.stdout
+    try:
+        sys.stdout = open(os.devnull, 'w')
+        res = fit.dofit(nlines, lstep, xstart, firstLine)
+        cost = fit.sumSqError(res[0])
+        return res[0], cost, res[2]["nfev"], res[4], res[3]
+    except Exception as err:
+        return xstart, np.inf, 0, -1, str(err)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
 class carousel(object):
     """ class for data describing the test carousel """
 
@@ -221,7 +619,7 @@ class carousel(object):
                 # assume last sample is labeled "Nothing"
                 for i in range(self.numSamples - 1):
                     try:
-                        self.filterAtt[i] = materialAtt(self.materialTypes[i],self.density[i])
+                        self.filterAtt[i] = getMaterialAtt(self.materialTypes[i],self.density[i])
                     except:
                         print("** failed to set carousel attenuation for ",self.materialTypes[i])
                 self.mask = np.zeros((self.numSamples),dtype=bool)
@@ -244,9 +642,30 @@ class carouselCalibrationData(object):
     The calibration file contains information about the X-ray voltage, take-off angle,
     target material and image resolution.
     It also gives the name & possibly the format of the image data file for the carousel.
+    If mmap is set the image file is memory mapped rather than read into memory, see
+    __mapImageFile. dtype is the type of the transformed image, float64 or float32.
+    If cache is set the transformed image, line centres, averages and image statistics
+    are saved in a directory beside the image file and used by later loads of the same
+    image, see __readSidecar; the image is then held as float32.
+    roi is None for the full image or a tuple of slices of the image lines and rows to
+    use, e.g. (slice(0,100,2), slice(None)); lines and rows are then those of the region
+    and only that part of the image file is read.
+    out is an optional array, e.g. the image of an earlier load, in which a uint16
+    image is transformed if it has the right shape and type, to save reallocating.
     """
-    def __init__(self, calFile, carouselInfo):
+    def __init__(self, calFile, carouselInfo, mmap=False, dtype="float64", cache=False, roi=None,
+                 out=None):
         self.calFile = calFile
+        # array that may be used for the transformed uint16 image, see __imageBuffer
+        self.__out = out
+        # number of zero pixels replaced in each uint16 image
+        self.zeroCounts = None
+        self.mmap = mmap
+        self.roi = None
+        self.imageDtype = np.dtype("float32" if cache else dtype)
+        # directory of the saved derived data, if used
+        self.cacheDir = None
+        self.__stats = None
         self.samples = carouselInfo.getSamples()-1 # note that last sample "Nothing" has no image
         self.voltage = None
         self.targeMat = None
@@ -279,18 +698,30 @@ class carouselCalibrationData(object):
         self.__centre = None
 
         self.__readCalFile(calFile)
+        # size of the images in the file, lines and rows are of the region used
+        self.fileLines = self.lines
+        self.fileRows = self.rows
+        if self.valid and roi is not None:
+            self.__setRegion(roi)
         if self.valid:
             try:
                 self.whiteLevel = 0
-                self.__readImageFile(self.imageFile)
-                self.__setAverages()
                 self.width = 100
+                # averages for each width used, so returning to a width is free
+                self.__aveByWidth = {}
                 self.__cacheAveSet = False
-                self.__cacheAve = np.zeros(shape=(self.samples, self.lines))
+                self.__cacheAve = None
                 logging.debug('initialised cacheAve')
+                if not (cache and self.__readSidecar()):
+                    self.__readImageFile(self.imageFile)
+                    self.__setAverages()
+                    if cache:
+                        self.__writeSidecar()
             except:
                 self.valid = False
                 logging.debug('reading data failed')
+        # do not keep the previous image alive when it was not reused
+        self.__out = None
 
     def __readCalFile(self, calFile):
         """ read calibration data file, and from that the actual image data"""
@@ -305,7 +736,7 @@ class carouselCalibrationData(object):
                     if self.targetMat != "W":
                         print("Warning: only W (Tungsten) target supported at present: not '", self.targetMat, "'")
                     try:
-                        self.targetAtten = materialAtt(self.targetMat,self.targetDensity)
+                        self.targetAtten = getMaterialAtt(self.targetMat,self.targetDensity)
                     except:
                         print("** failed to set target attenuation for ",self.targetMat)
                     try:
@@ -322,7 +753,7 @@ class carouselCalibrationData(object):
                         self.filterWidth[i] = float(self.__readLineStrip(fl))
                         self.filterDensity[i] = float(self.__readLineStrip(fl))
                         try:
-                            self.filterAtten[i] = materialAtt(self.filterMaterial[i],self.filterDensity[i])
+                            self.filterAtten[i] = getMaterialAtt(self.filterMaterial[i],self.filterDensity[i])
                         except:
                             print("** failed to set attenuation for ",self.filterMaterial[i])
 
@@ -330,7 +761,7 @@ class carouselCalibrationData(object):
                     self.detectorWidth = float(self.__readLineStrip(fl))
                     self.detectorDensity = float(self.__readLineStrip(fl))
                     try:
-                        self.detectorAtten = materialAtt(self.detectorMaterial,self.detectorDensity)
+                        self.detectorAtten = getMaterialAtt(self.detectorMaterial,self.detectorDensity)
                     except:
                         print("** failed to set detector attenuation for ",self.detectorMaterial)
                     self.valid = True
@@ -350,9 +781,49 @@ class carouselCalibrationData(object):
         else:
             return strng[:strng.find("#")].rstrip()
 
+    def __setRegion(self, roi):
+        """ set the lines and rows of the region roi of the image to use """
+        lineRange = range(*roi[0].indices(self.fileLines))
+        rowRange = range(*roi[1].indices(self.fileRows))
+        if roi[0].step not in (None, 1) and roi[0].step < 1 or roi[1].step not in (None, 1) or \
+           len(lineRange)<1 or len(rowRange)<1:
+            print("** error: image region must select lines and a range of rows from ",
+                  self.fileLines," lines and ",self.fileRows," rows")
+            self.valid = False
+            return
+        self.roi = (lineRange[0], lineRange[-1]+1, lineRange[1]-lineRange[0] if len(lineRange)>1 else 1,
+                    rowRange[0], rowRange[-1]+1)
+        self.lines = len(lineRange)
+        self.rows = len(rowRange)
+
+    def roiText(self):
+        """ description of the region of the image used, empty for the full image;
+            image line fitted line i is start+i*step """
+        if self.roi is None:
+            return ""
+        return "lines={0}:{1}:{2} rows={3}:{4}".format(*self.roi)
+
+    def __roiSlices(self):
+        """ slices of the image lines and rows for the region used """
+        if self.roi is None:
+            return slice(None), slice(None)
+        return slice(self.roi[0], self.roi[1], self.roi[2]), slice(self.roi[3], self.roi[4])
+
+    def __imageBuffer(self):
+        """ the array given to hold the transformed image, if it is suitable, else
+            None """
+        out = self.__out
+        self.__out = None
+        if out is None or isinstance(out, np.memmap) or out.dtype != self.imageDtype or \
+           out.shape != (self.samples, self.lines, self.rows) or not out.flags.c_contiguous:
+            return None
+        return out
+
     def __readImageFile(self, imageFile):
         """ read the image data based on specificed format """
-        if os.path.isfile(imageFile):
+        if os.path.isfile(imageFile) and (self.mmap or self.roi is not None):
+            self.__mapImageFile(imageFile)
+        elif os.path.isfile(imageFile):
             if self.imageFileFormat == "uint16":
                 # if raw uint16 data, assume first image is flat field and normalise
                 # rest of images by this and take log(I0/I)
@@ -361,23 +832,16 @@ class carouselCalibrationData(object):
                     tmpimage = np.fromfile(fl, dtype = self.imageFileFormat,
                                            count = self.rows*self.lines*nimages)
                     tmpimage = tmpimage.reshape(nimages, self.lines, self.rows)
-                self.image = np.zeros(self.rows*self.lines*self.samples,
-                                      dtype=float).reshape(self.samples, self.lines, self.rows)
-                # note - imported division from _future_ to avoid int div
-
                 # assume that the first image is the white level, I0, a constant
                 # over the image. To impose this assumption we take the average
                 # value over the first (flat field, shading corrected) image.
                 # This is only set for uint16; it is not known for float32
                 whiteLev = np.average(tmpimage[0,:,:])
                 self.whiteLevel = whiteLev
-                for i in range(nimages-1):
-                    # catch zero data:
-                    if np.min(tmpimage[i+1,:,:])==0:
-                        imt = tmpimage[i+1,:,:]
-                        imt[imt==0] = np.mean(imt)
-                        logging.warning('zero data replaced in image %d',i+1)
-                    self.image[i,:,:] = np.log( whiteLev / tmpimage[i+1,:,:] )
+                self.image, self.zeroCounts = logTransform(tmpimage[1:], whiteLev, 0,
+                                                           out=self.__imageBuffer(), dtype=self.imageDtype)
+                for i in np.nonzero(self.zeroCounts)[0]:
+                    logging.warning('zero data replaced in image %d',i+1)
 
             elif self.imageFileFormat == "uint16_65535":
                 # if raw uint16_65535 data, whitelevel set as 65535
@@ -387,17 +851,13 @@ class carouselCalibrationData(object):
                     tmpimage = np.fromfile(fl, dtype = "uint16",
                                            count = self.rows*self.lines*nimages)
                     tmpimage = tmpimage.reshape(nimages, self.lines, self.rows)
-                self.image = np.zeros(self.rows*self.lines*self.samples,
-                                      dtype=float).reshape(self.samples, self.lines, self.rows)
                 whiteLev = 65535
                 self.whiteLevel = whiteLev
-                for i in range(nimages):
-                    # catch zero data:
-                    if np.min(tmpimage[i,:,:])==0:
-                        imt = tmpimage[i,:,:]
-                        imt[imt==0] = np.mean(imt) + 1 # in case mean < 1.0 (imt is uint16)
-                        logging.warning('zero data replaced in image %d',i)
-                    self.image[i,:,:] = np.log( whiteLev / tmpimage[i,:,:] )
+                # zeros replaced by mean+1 in case mean < 1.0
+                self.image, self.zeroCounts = logTransform(tmpimage, whiteLev, 1,
+                                                           out=self.__imageBuffer(), dtype=self.imageDtype)
+                for i in np.nonzero(self.zeroCounts)[0]:
+                    logging.warning('zero data replaced in image %d',i)
 
             elif self.imageFileFormat == "float32":
                 # assume float data already transformed by I0 and log
@@ -413,19 +873,89 @@ class carouselCalibrationData(object):
         else:
             print("Image file not found!: ", imageFile)
 
+    def __mapImageFile(self, imageFile):
+        """ read the image data as __readImageFile but with the file memory mapped.
+            uint16 data is transformed to log(I0/I) a block of lines at a time into
+            an image held in an unnamed temporary file, so that the memory used does
+            not depend on the image size. float32 data is mapped copy on write, so
+            that changes to the image are not written to the file.
+            If a region is set only it is read, apart from the flat field image, and
+            if mmap is not set the image is held in memory. Zeros are then replaced
+            by the mean of the region.
+        """
+        shape = (self.samples, self.lines, self.rows)
+        fileShape = (self.samples, self.fileLines, self.fileRows)
+        lineSlice, rowSlice = self.__roiSlices()
+        if self.imageFileFormat == "float32":
+            self.image = np.memmap(imageFile, dtype="float32", mode="c", shape=fileShape)[:, lineSlice, rowSlice]
+            if not self.mmap:
+                self.image = np.array(self.image)
+            return
+        if self.imageFileFormat == "uint16":
+            first = 1
+        elif self.imageFileFormat == "uint16_65535":
+            first = 0
+        else:
+            print("** error: image format name ",self.imageFileFormat," not recognised")
+            return
+        raw = np.memmap(imageFile, dtype="uint16", mode="r", shape=(first+self.samples,)+fileShape[1:])
+        blocks = self.__blocks()
+        npix = self.lines*self.rows
+        if first:
+            # white level is the average of the whole flat field image, see __readImageFile
+            whiteLev = sum(raw[0, b].sum(dtype=np.uint64)
+                           for b in self.__blocks(self.fileLines, self.fileRows))/(self.fileLines*self.fileRows)
+        else:
+            whiteLev = 65535
+        self.whiteLevel = whiteLev
+        if self.mmap:
+            self.image = np.memmap(tempfile.TemporaryFile(), dtype=self.imageDtype, mode="w+", shape=shape)
+        else:
+            self.image = np.zeros(shape, dtype=self.imageDtype)
+        self.zeroCounts = np.zeros(self.samples, dtype=int)
+        for i in range(self.samples):
+            src = raw[first+i][lineSlice, rowSlice]
+            # zero data replaced by the mean, truncated to uint16, as __readImageFile
+            fill = None
+            if min(src[b].min() for b in blocks)==0:
+                mean = sum(src[b].sum(dtype=np.uint64) for b in blocks)/npix
+                fill = np.array([mean + (1-first)]).astype(np.uint16)
+                logging.warning('zero data replaced in image %d',i+first)
+            for b in blocks:
+                block, zeros = logTransform(src[b][np.newaxis], whiteLev, fill=fill,
+                                            out=self.image[i, b][np.newaxis])
+                self.zeroCounts[i] += zeros[0]
+
+    def imageStats(self):
+        """ return arrays of the NaN count, average and maximum of each image,
+            ignoring NaNs; the maximum is only found for images with NaNs """
+        if self.__stats is None:
+            nancount = np.zeros(self.samples, dtype=int)
+            ave = np.zeros(self.samples)
+            amax = np.zeros(self.samples)
+            for i in range(self.samples):
+                nancount[i] = np.count_nonzero(np.isnan(self.image[i,:,:]))
+                if nancount[i]>0:
+                    maskedimage = np.ma.array(self.image[i,:,:],mask = np.isnan(self.image[i,:,:]))
+                    ave[i] = np.ma.average(maskedimage)
+                    amax[i] = np.ma.max(maskedimage)
+                else:
+                    ave[i] = np.average(self.image[i,:,:])
+            self.__stats = (nancount, ave, amax)
+        return self.__stats
+
     def printImageStats(self, carInf):
         """ print out some data for each frame in the set of images"""
         max1 = int(self.voltage*2) # number of 0.5 KeV steps
         min10 = int(max1/10)
+        nancounts, aves, amax = self.imageStats()
         for i in range(self.samples):
-            nancount = np.count_nonzero(np.isnan(self.image[i,:,:]))
+            nancount = nancounts[i]
+            ave = aves[i]
             if nancount>0:
                 print("*** img ", i, " contains: ", nancount, " NaNs (", nancount*100./(self.rows*self.lines), "%)")
-                maskedimage = np.ma.array(self.image[i,:,:],mask = np.isnan(self.image[i,:,:]))
-                ave = np.ma.average(maskedimage)
-                print("    average(masked)= ", ave, "  max= ", np.ma.max(maskedimage))
+                print("    average(masked)= ", ave, "  max= ", amax[i])
             else:
-                ave = np.average(self.image[i,:,:])
                 print("img ", i, " ", carInf.materialTypes[i]," ", carInf.sampWidth[i], " average= ",ave)
             minmu = np.min(carInf.filterAtt[i].getMu()[min10:max1])
             maxmu = np.max(carInf.filterAtt[i].getMu()[min10:max1])
@@ -435,24 +965,106 @@ class carouselCalibrationData(object):
             if ave<minatt or ave>maxatt:
                 print("    *** Warning: Attenuation of sample outside expected bounds!")
 
+    def __sourceKey(self):
+        """ hash of the image file and the settings used to read it """
+        digest = hashlib.md5()
+        hashUpdate(digest, (SIDECAR_VERSION, fileHash(self.imageFile), self.imageFileFormat,
+                            self.samples, self.lines, self.rows, self.roiText()))
+        return digest.hexdigest()
+
+    def __sidecarName(self):
+        """ directory of the saved derived data, named after the image file and
+            the region used """
+        if self.roi is None:
+            return self.imageFile+".cache"
+        return self.imageFile+".lines{0}-{1}-{2}_rows{3}-{4}.cache".format(*self.roi)
+
+    def __readSidecar(self):
+        """ use the derived data saved by __writeSidecar if it was made from the
+            same image file; the image is memory mapped copy on write. Returns
+            False if there is no valid saved data. """
+        cacheDir = self.__sidecarName()
+        metaFile = os.path.join(cacheDir, "meta.npz")
+        if not os.path.isfile(metaFile) or not os.path.isfile(self.imageFile):
+            return False
+        try:
+            with np.load(metaFile) as meta:
+                if str(meta["source"]) != self.__sourceKey():
+                    print("Image file changed, remaking cache ",cacheDir)
+                    return False
+                self.whiteLevel = float(meta["whiteLevel"])
+                stats = (meta["nancount"], meta["ave"], meta["max"])
+            image = np.load(os.path.join(cacheDir, "image.npy"), mmap_mode="c")
+            centre = np.load(os.path.join(cacheDir, "centres.npy"))
+        except (IOError, OSError, KeyError, ValueError) as err:
+            print("Failed to read cache ",cacheDir,": ",err)
+            return False
+        if image.shape != (self.samples, self.lines, self.rows):
+            return False
+        self.image = image
+        self.__centre = centre
+        self.__stats = stats
+        self.cacheDir = cacheDir
+        print("Using cached image data from ",cacheDir)
+        return True
+
+    def __writeSidecar(self):
+        """ save the image, centres and statistics to the directory imageFile.cache,
+            with meta.npz written last recording the source file hash """
+        cacheDir = self.__sidecarName()
+        try:
+            if not os.path.isdir(cacheDir):
+                os.makedirs(cacheDir)
+            metaFile = os.path.join(cacheDir, "meta.npz")
+            if os.path.isfile(metaFile):
+                os.remove(metaFile)
+            for name in os.listdir(cacheDir):
+                if name.startswith("ave_"):
+                    os.remove(os.path.join(cacheDir, name))
+            self.__saveArray(cacheDir, "image.npy", self.image)
+            self.__saveArray(cacheDir, "centres.npy", self.__centre)
+            nancount, ave, amax = self.imageStats()
+            np.savez(metaFile+".tmp.npz", source=self.__sourceKey(), whiteLevel=self.whiteLevel,
+                     nancount=nancount, ave=ave, max=amax)
+            getattr(os, "replace", os.rename)(metaFile+".tmp.npz", metaFile)
+        except (IOError, OSError) as err:
+            print("** Failed to write cache ",cacheDir,": ",err)
+            return
+        self.cacheDir = cacheDir
+
+    def __saveArray(self, cacheDir, name, arr):
+        """ save arr as cacheDir/name via a temporary file """
+        path = os.path.join(cacheDir, name)
+        with open(path+".tmp", "wb") as fl:
+            np.save(fl, arr)
+        getattr(os, "replace", os.rename)(path+".tmp", path)
+
+    def __blocks(self, lines=None, rows=None):
+        """ slices of lines in blocks of about 4M pixels, to bound the memory of
+            temporary arrays for large images; by default of the region used """
+        lines = self.lines if lines is None else lines
+        rows = self.rows if rows is None else rows
+        blockLines = max(1, 4194304//rows)
+        return [slice(l, l+blockLines) for l in range(0, lines, blockLines)]
+
     def __setAverages(self):
-        """ pre compute mean centre of each image row
+        """ pre compute mean centre of each image row, a weighted average of
+            position by signal, in pixels. Centres outside the middle half of the
+            row are reset to the middle.
         """
         self.__centre = np.zeros(self.samples*self.lines).reshape(self.samples,
                                  self.lines)
+        pos = np.arange(self.rows)
         for samp in range(self.samples):
-            for li in range(self.lines):
-                self.__centre[samp, li] = self.__getCentrePos(li, samp)
-
-    def __getCentrePos(self, line, sample):
-        """ do a weighted average of position by signal to find the centre of
-            the signal, in pixels"""
-        vals = self.image[sample,line,:]
-        meanpt = np.sum(np.arange(len(vals))*vals)/np.sum(vals)
-        if meanpt>0.75*np.size(vals) or meanpt<0.25*np.size(vals):
-            meanpt = np.size(vals)*0.5
-            logging.info('reset getCentrePos to %f for sample %d',meanpt,sample)
-        return meanpt
+            for block in self.__blocks():
+                vals = self.image[samp, block, :]
+                self.__centre[samp, block] = np.sum(pos*vals, axis=1)/np.sum(vals, axis=1)
+            meanpt = self.__centre[samp]
+            reset = np.logical_or(meanpt>0.75*self.rows, meanpt<0.25*self.rows)
+            if np.any(reset):
+                meanpt[reset] = self.rows*0.5
+                logging.info('reset getCentrePos to %f for %d lines of sample %d',
+                             self.rows*0.5,np.count_nonzero(reset),samp)
 
     def getCentrePos(self, line, sample):
         """ get centre point"""
@@ -475,26 +1087,87 @@ class carouselCalibrationData(object):
 
     def getAvAtten(self, line, sample):
         """ average over a named range of rows """
-        if self.__cacheAveSet:
-            return self.__cacheAve[sample, line]
+        if not self.__cacheAveSet:
+            self.__calcAvAtten()
+        return self.__cacheAve[sample, line]
+
+    def getAvAttenArray(self):
+        """ return the (samples x lines) array of averages over rows, as used
+            by getAvAtten. The array is the cache itself so must not be modified """
+        if not self.__cacheAveSet:
+            self.__calcAvAtten()
+        return self.__cacheAve
+
+    def __calcAvAtten(self):
+        """ fill the cache of average attenuation for every sample and line. The
+            average over rows is found from the cumulative sums along each line,
+            built a block of lines at a time and then discarded, with the window
+            taken as a python slice of the line. Lines containing NaNs are
+            averaged directly. """
         logging.debug('calc cache values of Ave')
+        aveFile = None
+        if self.cacheDir is not None:
+            aveFile = os.path.join(self.cacheDir, "ave_"+repr(float(self.width))+".npy")
+            if os.path.isfile(aveFile):
+                self.__cacheAve = np.load(aveFile)
+                self.__aveByWidth[self.width] = self.__cacheAve
+                self.__cacheAveSet = True
+                return
+        self.__cacheAve = np.zeros(shape=(self.samples, self.lines))
+        self.__aveByWidth[self.width] = self.__cacheAve
         self.__cacheAveSet =True
-        for s in range(self.samples):
-            for l in range(self.lines):
-                logging.debug('s= %d l=%d c=%f', s, l, self.__centre[s, l])
-                rowStart = int(self.__centre[s, l]-self.width)
-                rowEnd = int(rowStart+2*self.width)
-                self.__cacheAve[s, l] = np.average(self.image[s, l, rowStart:rowEnd])
-        return self.__cacheAve[sample, line]
+        rowStart = np.trunc(self.__centre-self.width)
+        rowEnd = np.trunc(rowStart+2*self.width)
+        bad = np.logical_not(np.isfinite(rowStart))
+        rowStart[bad] = 0
+        rowEnd[bad] = 0
+        rowStart = rowStart.astype(int)
+        rowEnd = rowEnd.astype(int)
+        # python slice semantics: negative indices from the end, then clipped
+        first = np.clip(np.where(rowStart<0, rowStart+self.rows, rowStart), 0, self.rows)
+        last = np.clip(np.where(rowEnd<0, rowEnd+self.rows, rowEnd), 0, self.rows)
+        count = last-first
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for s in range(self.samples):
+                for block in self.__blocks():
+                    # cumulative sums of this block only, with a leading zero
+                    vals = self.image[s, block, :]
+                    sums = np.zeros((vals.shape[0], self.rows+1))
+                    np.cumsum(vals, axis=1, dtype=float, out=sums[:, 1:])
+                    lineIndex = np.arange(vals.shape[0])
+                    lo = first[s, block]
+                    hi = np.maximum(last[s, block], lo)
+                    total = sums[lineIndex, hi] - sums[lineIndex, lo]
+                    ave = np.where(count[s, block]>0, total/count[s, block], np.nan)
+                    for l in np.nonzero(np.isnan(sums[:, -1]))[0]:
+                        ave[l] = np.average(vals[l, rowStart[s, block][l]:rowEnd[s, block][l]])
+                    self.__cacheAve[s, block] = ave
+        self.__cacheAve[bad] = np.nan
+        if aveFile is not None:
+            try:
+                self.__saveArray(self.cacheDir, os.path.basename(aveFile), self.__cacheAve)
+            except (IOError, OSError) as err:
+                print("** Failed to save averages to cache: ",err)
 
     def setWidthAve(self, width):
         """ set the (half) width to be used when calculating the average
             attenuation along a row
             This is measured either size of the centre point. All points should
-            lie on the sample image.
+            lie on the sample image. Averages already found for this width
+            are reused.
         """
         self.width = width
+        self.__cacheAve = self.__aveByWidth.get(width)
+        self.__cacheAveSet = self.__cacheAve is not None
+
+    def clearAvAtten(self):
+        """ discard the averages for all widths; must be called if the image
+            data is changed. The saved data, if any, is no longer used. """
+        self.cacheDir = None
+        self.__stats = None
+        self.__aveByWidth = {}
         self.__cacheAveSet = False
+        self.__cacheAve = None
 
     def isValid(self):
         """ is object ok"""
@@ -547,6 +1220,124 @@ class carouselCalibrationData(object):
 
 
 
+class fitCancelled(Exception):
+    """ Raised by fitData.objFunSq when a running fit is cancelled """
+    pass
+
+
+class fitContext(object):
+    """ Values used by every evaluation of the fit model that do not depend on the
+        fit variables. Built once per fit by fitData.prepareFit from the current
+        carousel and calibration settings; the arrays are read only.
+        The model is evaluated on the energy grid of the spectrum or, if nbins>0,
+        on a reduced grid of about nbins energies from reduceEnergyGrid.
+
+    Attributes
+
+    xe : array
+        energies at which the model is evaluated
+    weights : array
+        number of points of the full grid represented by each energy
+    reduced : bool
+        True if a reduced energy grid is used
+    minpt : int
+        index of first energy used in the fit; the lowest 10% are dropped
+    spec : array or None
+        source spectrum at xe, None if no pre-computed spectrum
+    muTarget, muDetector, muFilter : array
+        attenuation of the target, detector and the varied filter at xe
+    attFixed : array
+        summed attenuation of the filters that are not varied
+    trans : array
+        (samples x energies) transmission through each carousel sample
+    use : array
+        True for each sample included in the fit, i.e. not masked
+    expt : array
+        (lines x samples) observed average attenuation
+
+    If previous, the context of an earlier fit, is given the energy grid, filter
+    and sample attenuation are taken from it where their inputs are unchanged.
+    """
+
+    def __init__(self, fit, nbins=0, previous=None):
+        carCal = fit.carCal
+        carInfo = fit.carInfo
+        # inputs of each part of the context, so that a context for a refit can
+        # reuse the parts of the previous one that are unchanged
+        self.sources = (carCal, carInfo, nbins)
+        self.filterKey = (fit.varFilter, tuple(carCal.filterWidth[filt] for filt in range(carCal.filterCount)))
+        self.sampleKey = tuple(carInfo.sampWidth)
+        if previous is not None and previous.sources[0] is carCal and \
+           previous.sources[1] is carInfo and previous.sources[2] == nbins:
+            for name in ("xe", "weights", "reduced", "minpt", "spec", "muTarget", "muDetector"):
+                setattr(self, name, getattr(previous, name))
+        else:
+            previous = None
+            self.setGrid(fit, nbins)
+        if previous is not None and previous.filterKey == self.filterKey:
+            self.muFilter = previous.muFilter
+            self.attFixed = previous.attFixed
+        else:
+            self.setFilters(fit)
+        nsamples = carInfo.numSamples - 1
+        if previous is not None and previous.sampleKey == self.sampleKey:
+            self.trans = previous.trans
+        else:
+            mumat = self.muStack([carInfo.filterAtt[sample] for sample in range(nsamples)])
+            self.trans = np.exp(-carInfo.sampWidth[:nsamples, np.newaxis]*mumat)
+        self.use = np.logical_not(carInfo.mask[:nsamples])
+        self.expt = np.ascontiguousarray(carCal.getAvAttenArray().T)
+        for arr in (self.muFilter, self.attFixed, self.trans, self.use, self.expt, self.weights):
+            arr.flags.writeable = False
+
+    def setGrid(self, fit, nbins):
+        """ set the energy grid and the attenuation of the target and detector """
+        carCal = fit.carCal
+        carInfo = fit.carInfo
+        xe = carCal.spec.getE()
+        n = len(xe)
+        self.minpt = int(0.1*n)
+        self.spec = carCal.spec.getS()
+        self.reduced = nbins > 0 and nbins < n
+        if self.reduced:
+            # bins must not span an absorption edge, where mu rises with energy
+            nsamples = carInfo.numSamples - 1
+            materials = [carCal.targetAtten, carCal.detectorAtten]
+            materials += [carCal.filterAtten[filt] for filt in range(carCal.filterCount)]
+            materials += [carInfo.filterAtt[sample] for sample in range(nsamples)]
+            mumat = muMatrix(materials, n)
+            breaks = np.nonzero(np.any(np.diff(mumat, axis=1) > 0., axis=0))[0]+1
+            self.xe,self.weights,self.spec,self.minpt = reduceEnergyGrid(xe,self.spec,
+                                                                          self.minpt,nbins,breaks)
+        else:
+            self.xe = xe
+            self.weights = np.ones(n)
+        self.muTarget = self.muOf(carCal.targetAtten)
+        self.muDetector = self.muOf(carCal.detectorAtten)
+
+    def setFilters(self, fit):
+        """ set the attenuation of the varied filter and of the fixed filters """
+        carCal = fit.carCal
+        if fit.varFilter > -1:
+            self.muFilter = self.muOf(carCal.filterAtten[fit.varFilter])
+        else:
+            self.muFilter = np.zeros(len(self.xe))
+        fixed = [filt for filt in range(carCal.filterCount) if filt != fit.varFilter]
+        widths = np.array([carCal.filterWidth[filt] for filt in fixed])
+        self.attFixed = np.dot(widths, self.muStack([carCal.filterAtten[filt] for filt in fixed]))
+
+    def muOf(self, mat):
+        """ attenuation of a materialAtt object at the energies xe """
+        if self.reduced:
+            return mat.getMuByE(self.xe)
+        return mat.getMu()[:len(self.xe)]
+
+    def muStack(self, materials):
+        """ (materials x energies) matrix of attenuation at the energies xe """
+        if self.reduced:
+            return muMatrix(materials, len(self.xe), self.xe)
+        return muMatrix(materials, len(self.xe))
+
 class fitData(object):
     """ This object contains fit related data and functions
     """
@@ -595,11 +1386,62 @@ class fitData(object):
         self.atten = np.zeros([self.carCal.lines,self.carInfo.getSamples()])
         self.objFnCalls = 0
         self.nlines = 0
+        # first image line of the fitted range; line numbers used in the
+        # polynomials are relative to this
+        self.firstLine = 0
         self.lineStep = 1
         self.linestep = 1
         self.bounds = False
         self.boundsValues = {}
         self.solver = "old"
+        # Jacobian used by the solvers: "numeric" (finite differences in scipy),
+        # "analytic" (jacFunSq), "check" (analytic, after comparison with
+        # finite differences at the starting point) or "batch" (finite differences
+        # evaluated together by batchJacFunSq, over jacThreads threads if >1)
+        self.jacobian = "numeric"
+        self.jacThreads = 0
+        # residuals and condition numbers of the polynomial fits in linesPolyFit
+        self.polyFitInfo = {}
+        # best fit values of the last completed fit, the start of a refit
+        self.solution = None
+        # fit invariant values, see prepareFit, and recent model evaluations
+        self.context = None
+        # context of an earlier fit from which a refit may reuse values
+        self.previousContext = None
+        self.memo = []
+        self.memoSize = 4
+        # if >0 evaluate the model on a reduced grid of about this many energies
+        self.energyBins = 0
+        # forward model: "numpy" or "numba", the compiled kernel if numba is present
+        self.engine = "numpy"
+        # "poly" fits the target and detector widths as polynomials in line number,
+        # "perline" fits a value for each fitted line, see perLineFit. smooth weights
+        # the differences between neighbouring lines; perLineAt are the fitted lines.
+        self.lineMode = "poly"
+        self.smooth = 1.0
+        self.perLineAt = None
+        # residuals returned by objFunSq: "squared" differences in attenuation, as
+        # originally used, or "signed" differences, whose squares the solvers sum
+        self.residual = "squared"
+        # options passed to the solvers, named as for least_squares: ftol, xtol,
+        # gtol, max_nfev, x_scale, diff_step, loss, tr_solver and verbose
+        self.solverOptions = {}
+        # (elapsed time, cost, step norm, improved) for each evaluation of objFunSq
+        # by the solver in the last fit; the step is from the best point so far
+        self.trace = []
+        self.traceStart = None
+        self.traceBest = None
+        # set, e.g. from another thread, to stop a running fit
+        self.cancelRequested = False
+        # if checkpointFile is set, the best point found by the solver is saved
+        # every checkpointEvals evaluations or checkpointSeconds, if >0, and at the
+        # end of the solver, see writeCheckpoint
+        self.checkpointFile = None
+        self.checkpointEvals = 0
+        self.checkpointSeconds = 0.
+        self.ckptCount = 0
+        self.ckptTime = 0.
+        self.hashes = None
 
     def calcWidths(self,x0,nlines,xe):
         """ Function to return the 3 widths for the target,
@@ -609,54 +1451,81 @@ class fitData(object):
             order polynomials.
             Also returns the energy array which can be a polynomial:
             E+aE**2+... ; this should be constrained >=0, not done at
-            present."""
+            present.
+            x0 may also be a (n x variables) batch of values, in which case
+            the fitted results have a leading axis of length n.
+            After perLineFit the target and detector widths are given by one
+            value for each line in perLineAt, interpolated between them."""
         lines=np.array(range(nlines),dtype="double")
+        x0 = np.asarray(x0)
         nt = self.vary_target+1
         nd = self.vary_detector+1
         nf = self.vary_filter+1
         ne = self.vary_energy+1
         ns = self.vary_epk+self.vary_ewidlow+self.vary_ewidhigh+3
-        if len(x0)<nt+nd+nf+ne+ns:
+
+        def polyval(coeffs,var):
+            """ np.polyval, for each row of coefficients if a batch """
+            if coeffs.ndim>1:
+                coeffs = coeffs.T[...,np.newaxis]
+            return np.polyval(coeffs,var)
+
+        def perLine(vals,var):
+            """ widths at lines var from the values at perLineAt """
+            if vals.ndim>1:
+                return np.array([np.interp(var,self.perLineAt,row) for row in vals])
+            return np.interp(var,self.perLineAt,vals)
+
+        lineFun = polyval
+        if self.perLineAt is not None:
+            lineFun = perLine
+            if nt>0:
+                nt = len(self.perLineAt)
+            if nd>0:
+                nd = len(self.perLineAt)
+        if x0.shape[-1]<nt+nd+nf+ne+ns:
             print("** calcWidthd called with too few values in x0")
             sys.exit(1)
         # Polynomial expressions: highest order term is first in the array.
         if nt>0:
-            twidth = np.polyval(x0[:nt],lines)
+            twidth = lineFun(x0[...,:nt],lines)
         else:
             twidth = np.polyval(self.defaults[0:1],lines)
         #twidth=np.polyval(x0[nt-1:0:-1],lines)
         if nd>0:
-            dwidth = np.polyval(x0[nt:nt+nd],lines)
+            dwidth = lineFun(x0[...,nt:nt+nd],lines)
         else:
             dwidth = np.polyval(self.defaults[1:2],lines)
         #dwidth=np.polyval(x0[nt+nd-1:nt:-1],lines)
         dwidth = np.exp( dwidth ) # force >0 by working in log space
         if nf>0:
-            fwidth = np.polyval(x0[nt+nd:nt+nd+nf],lines)
+            fwidth = polyval(x0[...,nt+nd:nt+nd+nf],lines)
         else:
             fwidth = np.polyval(self.defaults[2:3],lines)
         if ne>0:
             # This term should be constrained as >=0 for all xe but is not at present.
             # -Ve values will give errors in output stage.
-            ecoeffs = xe + xe*xe*(np.polyval(x0[nt+nd+nf:nt+nd+nf+ne],xe))
+            ecoeffs = xe + xe*xe*(polyval(x0[...,nt+nd+nf:nt+nd+nf+ne],xe))
         else:
             ecoeffs = xe
         if ns>0:
             i0 = nt+nd+nf+ne
-            indarr = xe>x0[i0:i0+1]
-            spectra = xe-x0[i0:i0+1]
-            spectra[indarr] = spectra[indarr]*x0[i0+1:i0+2]
-            spectra[~indarr] = spectra[~indarr]*x0[i0+2:i0+3]
+            spectra = xe-x0[...,i0:i0+1]
+            spectra = np.where(xe>x0[...,i0:i0+1],spectra*x0[...,i0+1:i0+2],spectra*x0[...,i0+2:i0+3])
             spectra = np.exp(-spectra**2)
-            # mask out lowest 10% of spectra, as in spekCalc
-            masklen = int(len(spectra)*0.1)
-            spectra[0:masklen] = 0.
+            # mask out lowest 10% of spectra, as in spekCalc; done by energy as xe
+            # may be a reduced grid
+            specE = self.carCal.spec.getE()
+            spectra[...,xe<specE[int(len(specE)*0.1)]] = 0.
         else:
             spectra = 0.
         return twidth,dwidth,fwidth,ecoeffs,spectra
 
-    def dofit(self,nlines,lstep,xin):
-        """ perform fit """
+    def dofit(self,nlines,lstep,xin,firstLine=0,final=True,perLineX=False):
+        """ perform fit to nlines lines, every lstep'th, starting at image line
+            firstLine. If final, the model is then evaluated on every line.
+            perLineX is set if xin holds the values of a per line fit, see
+            perLineFit. """
         got=0
         try:
             # from scipy.optimize import minimize
@@ -669,103 +1538,562 @@ class fitData(object):
                 print("** cannot find scipy leastsq or least_squares - check python has scipy")
                 return
 
+        if self.lineMode == "perline":
+            return self.perLineFit(nlines,lstep,xin,firstLine,final,perLineX)
         if self.verbose:
             pdb.set_trace()
         x = xin
         self.nlines = nlines
         self.lineStep = lstep
+        self.firstLine = firstLine
+        self.prepareFit()
+        if self.context.reduced:
+            print("Reduced energy grid of ",len(self.context.xe)," points; max attenuation error at start = ",
+                  self.gridError(x))
+
+        if self.jacobian == "check":
+            self.checkJacobian(x)
+        if self.jacobian in ("analytic", "check"):
+            jacFun = self.jacFunSq
+        elif self.jacobian == "batch":
+            jacFun = self.batchJacFunSq
+        else:
+            jacFun = None
 
         # use either old or new solver interface from scipy for least squares
-        if self.solver=="old":
-            res = leastsq(self.objFunSq, x, full_output = True)
-        else:
-            if self.bounds:
-                resobj = least_squares(self.objFunSq, x, verbose = 1, bounds=self.boundsValues)
+        self.startTrace()
+        try:
+            if self.solver=="old":
+                if jacFun is not None:
+                    res = leastsq(self.objFunSq, x, Dfun=jacFun, full_output = True, **self.leastsqArgs(len(x)))
+                else:
+                    res = leastsq(self.objFunSq, x, full_output = True, **self.leastsqArgs(len(x)))
             else:
-                resobj = least_squares(self.objFunSq, x, verbose = 1, method='lm')
-            infodict = {"nfev":resobj.nfev}
-            cov = [0]
-            res = (resobj.x,cov,infodict,resobj.message,resobj.status)
-
-        print("Line 0 atten=",self.atten[0,:])
+                if jacFun is not None:
+                    jac = jacFun
+                else:
+                    jac = '2-point'
+                kwargs = self.leastSquaresArgs()
+                if self.bounds:
+                    resobj = least_squares(self.objFunSq, x, jac=jac, bounds=self.boundsValues, **kwargs)
+                else:
+                    if "loss" not in kwargs and "tr_solver" not in kwargs:
+                        kwargs["method"] = 'lm'
+                    resobj = least_squares(self.objFunSq, x, jac=jac, **kwargs)
+                infodict = {"nfev":resobj.nfev}
+                cov = [0]
+                res = (resobj.x,cov,infodict,resobj.message,resobj.status)
+        finally:
+            self.stopTrace()
+
+        print("Line",firstLine,"atten=",self.atten[firstLine,:])
         expt = np.zeros(self.carCal.samples+1)
         for i in range(self.carCal.samples):
-            expt[i] = self.carCal.getAvAtten(0,i)
-        print("Line 0 expt=",expt)
+            expt[i] = self.carCal.getAvAtten(firstLine,i)
+        print("Line",firstLine,"expt=",expt)
+        if not final:
+            return res
         # Do final calulation on all lines:
         self.lineStep = 1
         if self.solver=="old":
             self.objFunSq(res[0])
         else:
             self.objFunSq(resobj.x)
+        if self.context.reduced:
+            print("Reduced energy grid: max attenuation error at solution = ",self.gridError(res[0]))
         #
         return res
 
+    def prepareFit(self):
+        """ Build the fit invariant context used by the model evaluations and clear
+            the memo of previous evaluations. Must be called again if the carousel
+            mask, filters or averaging width change. If previousContext is set,
+            parts of it still valid are reused. """
+        self.context = fitContext(self,self.energyBins,self.previousContext)
+        self.memo = []
+
+    def gridError(self,x):
+        """ Return the largest difference in the model attenuation of the selected
+            lines between the current, reduced, energy grid and the full grid """
+        context,memo = self.context,self.memo
+        attReduced = self.lineAtten(x)
+        self.context,self.memo = fitContext(self),[]
+        attFull = self.lineAtten(x)
+        self.context,self.memo = context,memo
+        return np.nanmax(np.abs(attReduced-attFull))
+
+    def lineAtten(self,x):
+        """ model attenuation, log(i0/i_sample), for the selected lines and all
+            samples """
+        lines,at_se,at_se_t,trans,i0,i_sample = self.__forward(x)
+        return np.log(i0[:,np.newaxis]/i_sample)
+
+    def sumSqError(self,x):
+        """ sum of the squared errors in attenuation over the unmasked samples of
+            the selected lines, whichever residual is used by the solver """
+        ctx = self.getContext()
+        lines = np.arange(0,self.nlines,self.lineStep)
+        err = self.lineAtten(x) - ctx.expt[self.firstLine+lines,:]
+        return np.sum(err[:,ctx.use]**2)
+
+    def getContext(self):
+        """ return the fit context, building it if not yet done """
+        if self.context is None:
+            self.prepareFit()
+        return self.context
+
+    def scheduleFit(self,nlines,steps,xin,firstLine=0):
+        """ Coarse to fine fit: fit with each line step in steps in turn, each
+            starting from the solution of the previous one. Only the last is
+            followed by evaluation on every line. Returns the dofit result of the
+            last level, with nfev the total over all levels, and a list of
+            (step, time, nfev, status) for each level.
+            """
+        x = xin
+        levels = []
+        nfev = 0
+        for level,step in enumerate(steps):
+            t0 = timeit.default_timer()
+            res = self.dofit(nlines,step,x,firstLine,final=(level==len(steps)-1))
+            levels.append((step,timeit.default_timer()-t0,res[2]["nfev"],res[4]))
+            nfev += res[2]["nfev"]
+            x = res[0]
+            print("schedule level ",level," line step ",step," time=",levels[-1][1],
+                  " nfev=",levels[-1][2])
+        res[2]["nfev"] = nfev
+        return res,levels
+
+    def perLineFit(self,nlines,lstep,xin,firstLine=0,final=True,perLineX=False):
+        """ Fit with separate target and detector widths for each fitted line,
+            every lstep'th, and lines between them interpolated. xin has the
+            usual polynomial layout and gives the starting widths or, if perLineX,
+            holds the per line values of a previous fit of the same lines. Signed
+            residuals are always used; squared residuals leave the widths of
+            each line almost at their starting values. Neighbouring
+            lines are coupled by residuals sqrt(smooth) times the differences of
+            their widths. Each line depends only on its own widths and the global
+            variables, so least_squares is given the sparsity of the Jacobian and
+            the cost grows linearly with the number of lines. Returns the result
+            as dofit, with the per line values in place of the polynomials.
+            """
+        from scipy.optimize import least_squares
+        if self.jacobian != "numeric":
+            print("Per line fit uses a sparse finite difference Jacobian; jac=",self.jacobian," ignored")
+        if self.residual != "signed":
+            print("Per line fit uses signed residuals; residual=",self.residual," ignored")
+            self.residual = "signed"
+        self.nlines = nlines
+        self.lineStep = lstep
+        self.firstLine = firstLine
+        self.perLineAt = None
+        self.prepareFit()
+        fitLines = np.arange(0,nlines,lstep)
+        nt = self.vary_target+1
+        nd = self.vary_detector+1
+        if not perLineX:
+            tw,dw,fw,ec,spectra = self.calcWidths(xin,nlines,self.context.xe)
+            blocks = []
+            if nt>0:
+                blocks.append(tw[fitLines])
+            if nd>0:
+                blocks.append(np.log(dw[fitLines]))
+            x = np.concatenate(blocks+[np.asarray(xin,dtype="double")[nt+nd:]])
+        else:
+            # already per line values, e.g. from a checkpoint or previous fit
+            x = np.array(xin,dtype="double")
+        self.perLineAt = fitLines
+        if self.context.reduced:
+            print("Reduced energy grid of ",len(self.context.xe)," points; max attenuation error at start = ",
+                  self.gridError(x))
+        self.startTrace()
+        try:
+            resobj = least_squares(self.objFunSq, x, jac_sparsity=self.perLineSparsity(len(x)),
+                                   method='trf', **self.leastSquaresArgs())
+        finally:
+            self.stopTrace()
+        res = (resobj.x,[0],{"nfev":resobj.nfev},resobj.message,resobj.status)
+        print("Line",firstLine,"atten=",self.atten[firstLine,:])
+        if not final:
+            return res
+        self.lineStep = 1
+        self.objFunSq(resobj.x)
+        if self.context.reduced:
+            print("Reduced energy grid: max attenuation error at solution = ",self.gridError(res[0]))
+        return res
+
+    def leastSquaresArgs(self):
+        """ keyword arguments for least_squares from solverOptions """
+        kwargs = {"verbose":1}
+        kwargs.update(self.solverOptions)
+        return kwargs
+
+    def leastsqArgs(self,nvar):
+        """ keyword arguments for leastsq from solverOptions, mapped to the
+            names used by leastsq; loss, tr_solver and verbose have no equivalent """
+        opts = self.solverOptions
+        kwargs = {}
+        for key,name in (("ftol","ftol"),("xtol","xtol"),("gtol","gtol"),("max_nfev","maxfev")):
+            if key in opts:
+                kwargs[name] = opts[key]
+        if "diff_step" in opts:
+            # leastsq steps by sqrt(epsfcn) relative to x
+            kwargs["epsfcn"] = opts["diff_step"]**2
+        if "x_scale" in opts and not isinstance(opts["x_scale"],str):
+            # diag multiplies the variables so is the inverse of x_scale
+            kwargs["diag"] = 1./np.broadcast_to(np.asarray(opts["x_scale"],dtype="double"),(nvar,))
+        for key in ("loss","tr_solver","verbose"):
+            if key in opts:
+                print("Option ",key," only applies to solver=new; ignored")
+        return kwargs
+
+    def startTrace(self):
+        """ start recording evaluations of objFunSq in trace """
+        self.trace = []
+        self.traceBest = None
+        self.traceStart = timeit.default_timer()
+        self.ckptCount = 0
+        self.ckptTime = self.traceStart
+
+    def stopTrace(self):
+        """ stop recording evaluations, saving a final checkpoint if enabled """
+        if self.checkpointFile is not None and self.traceStart is not None:
+            self.writeCheckpoint()
+        self.traceStart = None
+
+    def varyOrders(self):
+        """ array of the polynomial orders set for the fit variables """
+        return np.array([self.vary_target, self.vary_detector, self.vary_filter, self.vary_energy,
+                         self.vary_epk, self.vary_ewidlow, self.vary_ewidhigh])
+
+    def inputHashes(self):
+        """ dict of md5 hashes of the carousel definition, calibration and image
+            files, computed once """
+        if self.hashes is None:
+            self.hashes = {}
+            for name,filename in (("carousel",self.carInfo.defFile),("calibration",self.carCal.calFile),
+                                  ("image",self.carCal.imageFile)):
+                self.hashes[name] = fileHash(filename)
+        return self.hashes
+
+    def inputKey(self, extra):
+        """ Return a hex key for the result cache that identifies all the inputs
+            to a fit with this object: the image data and average width, the
+            carousel and calibration settings and materials, spectrum, mask, vary
+            settings, default values and fit options, the source of this module,
+            the numpy and scipy versions, and extra, a dict of the remaining
+            inputs such as the initial values, lines to fit and the source of the
+            calling program. """
+        digest = hashlib.md5()
+        carInfo = self.carInfo
+        carCal = self.carCal
+        import scipy
+        hashUpdate(digest, fileHash(os.path.splitext(os.path.abspath(__file__))[0]+".py"))
+        hashUpdate(digest, (np.__version__, scipy.__version__))
+        hashUpdate(digest, (carCal.image, carCal.width, carCal.lines, carCal.rows, carCal.roiText()))
+        hashUpdate(digest, (carInfo.numSamples, carInfo.materialTypes, carInfo.density,
+                            carInfo.sampWidth, carInfo.mask, carInfo.filterAtt))
+        hashUpdate(digest, (carCal.voltage, carCal.angle, carCal.filterMaterial, carCal.filterWidth,
+                            carCal.filterDensity, carCal.filterAtten, carCal.detectorMaterial,
+                            carCal.detectorWidth, carCal.detectorDensity, carCal.detectorAtten,
+                            carCal.targetMat, carCal.targetDensity, carCal.targetAtten))
+        spec = carCal.spec.getS()
+        hashUpdate(digest, (carCal.spec.getE(), np.zeros(0) if spec is None else spec))
+        hashUpdate(digest, (self.varyOrders(), np.asarray(self.defaults,dtype="double"), self.varFilter))
+        hashUpdate(digest, (self.bounds, self.boundsValues))
+        hashUpdate(digest, (self.solver, self.jacobian, self.energyBins, self.engine, self.lineMode,
+                            self.smooth, self.residual, self.solverOptions))
+        hashUpdate(digest, extra)
+        return digest.hexdigest()
+
+    def fitState(self):
+        """ Return a dict of the arrays describing the last fit that are needed to
+            restore it with restoreFitState; used by the result cache. """
+        perLineAt = np.zeros(0,dtype=int) if self.perLineAt is None else self.perLineAt
+        return {"atten":self.atten, "nlines":self.nlines, "lineStep":self.lineStep,
+                "firstLine":self.firstLine, "perLineAt":perLineAt}
+
+    def restoreFitState(self, state):
+        """ Set this object as if it had made the fit saved by fitState """
+        self.atten = np.array(state["atten"])
+        self.nlines = int(state["nlines"])
+        self.lineStep = int(state["lineStep"])
+        self.firstLine = int(state["firstLine"])
+        self.perLineAt = None
+        if self.lineMode == "perline":
+            self.perLineAt = np.array(state["perLineAt"])
+
+    def writeCheckpoint(self):
+        """ Save the best point found by the solver so far to checkpointFile, with
+            the vary settings, default values, mask, fitted lines and hashes of the
+            input files. Written to a temporary file then renamed, so an existing
+            checkpoint is not lost if interrupted. """
+        if self.traceBest is None:
+            return
+        cost,x = self.traceBest
+        hashes = self.inputHashes()
+        names = sorted(hashes)
+        tmpFile = self.checkpointFile+".tmp.npz"
+        np.savez(tmpFile, x=x, cost=cost, nfev=self.objFnCalls, vary=self.varyOrders(),
+                 defaults=np.asarray(self.defaults,dtype="double"), mask=self.carInfo.mask,
+                 nlines=self.nlines, firstLine=self.firstLine, lineStep=self.lineStep,
+                 lineMode=self.lineMode, roi=self.carCal.roiText(), hashNames=np.array(names),
+                 hashValues=np.array([hashes[n] for n in names]))
+        getattr(os,"replace",os.rename)(tmpFile,self.checkpointFile)
+        self.ckptCount = len(self.trace)
+        self.ckptTime = timeit.default_timer()
+
+    def checkResume(self,ckpt,nlines,lstep,firstLine=0):
+        """ Return a list of the reasons, if any, that the checkpoint ckpt from
+            readCheckpoint can not be used to resume a fit of nlines lines with
+            this object: changed input files, vary settings or mask, or for a per
+            line fit different fitted lines. """
+        problems = []
+        hashes = self.inputHashes()
+        for name in sorted(hashes):
+            if ckpt["hashes"].get(name) != hashes[name]:
+                problems.append(name+" file has changed")
+        if not np.array_equal(ckpt["vary"],self.varyOrders()):
+            problems.append("vary settings differ: "+str(ckpt["vary"]))
+        if str(ckpt.get("roi","")) != self.carCal.roiText():
+            problems.append("image region differs: "+str(ckpt.get("roi","")))
+        if not np.array_equal(ckpt["mask"],self.carInfo.mask):
+            problems.append("sample mask differs: "+str(ckpt["mask"]))
+        if str(ckpt["lineMode"]) != self.lineMode:
+            problems.append("line mode differs: "+str(ckpt["lineMode"]))
+        elif self.lineMode == "perline" and (int(ckpt["nlines"]) != nlines or
+                int(ckpt["lineStep"]) != lstep or int(ckpt["firstLine"]) != firstLine):
+            problems.append("per line fit of different lines")
+        return problems
+
+    def recordTrace(self,x,resid):
+        """ add an evaluation to the trace if recording: the elapsed time, cost,
+            norm of the step from the best point so far and if it is a step of
+            the solver that improved on it """
+        if self.traceStart is None:
+            return
+        cost = 0.5*np.dot(resid,resid)
+        x = np.array(x,dtype="double")
+        if self.traceBest is None:
+            step = 0.
+            improved = True
+        else:
+            step = np.linalg.norm(x-self.traceBest[1])
+            # a change in a single variable is taken to be for a finite difference
+            # Jacobian, not a step of the solver
+            single = len(x)>1 and np.count_nonzero(x!=self.traceBest[1])==1
+            improved = cost < self.traceBest[0] and not single
+        if improved:
+            self.traceBest = (cost,x)
+        now = timeit.default_timer()
+        self.trace.append((now-self.traceStart,cost,step,improved))
+        if self.checkpointFile is not None:
+            if (self.checkpointEvals>0 and len(self.trace)-self.ckptCount>=self.checkpointEvals) or \
+               (self.checkpointSeconds>0. and now-self.ckptTime>=self.checkpointSeconds):
+                self.writeCheckpoint()
+
+    def smoothResid(self,x):
+        """ residuals coupling the per line widths of neighbouring fitted lines """
+        nl = len(self.perLineAt)
+        nblocks = int(self.vary_target>-1)+int(self.vary_detector>-1)
+        vals = np.asarray(x)[:nblocks*nl].reshape(nblocks,nl)
+        return np.sqrt(self.smooth)*np.diff(vals,axis=1).ravel()
+
+    def perLineSparsity(self,nvar):
+        """ sparsity structure of the Jacobian of objFunSq for perLineFit: the
+            residuals of a line depend on its own widths and the global variables,
+            the smoothing residuals on the widths of two neighbouring lines.
+            nvar is the number of fit variables.
+            """
+        from scipy.sparse import coo_matrix
+        nsamples = self.carInfo.numSamples - 1
+        nl = len(self.perLineAt)
+        nblocks = int(self.vary_target>-1)+int(self.vary_detector>-1)
+        nglobal = nvar-nblocks*nl
+        ndata = self.nlines*nsamples
+        # data rows of each fitted line, omitting masked samples
+        used = np.nonzero(self.getContext().use)[0]
+        drows = self.perLineAt[:,np.newaxis]*nsamples+used
+        rows = []
+        cols = []
+        for b in range(nblocks):
+            rows.append(drows.ravel())
+            cols.append(np.repeat(b*nl+np.arange(nl),len(used)))
+            prows = ndata+b*(nl-1)+np.arange(nl-1)
+            rows.extend([prows,prows])
+            cols.extend([b*nl+np.arange(nl-1),b*nl+np.arange(1,nl)])
+        for g in range(nglobal):
+            rows.append(drows.ravel())
+            cols.append(np.full(drows.size,nblocks*nl+g))
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        return coo_matrix((np.ones(len(rows),dtype=int),(rows,cols)),
+                          shape=(ndata+nblocks*(nl-1),nvar)).tocsr()
+
+    def multiStartFit(self,nlines,lstep,starts,firstLine=0,workers=None):
+        """ Fit from each of the starting points in starts, running the fits
+            concurrently in a pool of worker processes if available. Returns the
+            dofit result for the best fit, measured by the sum of squared errors
+            over all lines, and a list of (start, solution, error, nfev, status)
+            for every start. On return the state of this object is that of the
+            best fit.
+            """
+        import copy
+        # the workers only need the averaged data, not the images
+        self.carCal.getAvAttenArray()
+        carCal = copy.copy(self.carCal)
+        carCal.image = None
+        worker = copy.copy(self)
+        worker.carCal = carCal
+        worker.context = None
+        worker.memo = []
+        worker.checkpointFile = None
+        jobs = [(xs,nlines,lstep,firstLine) for xs in starts]
+        outcomes = None
+        if workers != 1:
+            try:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=workers,initializer=_initStartWorker,
+                                         initargs=(worker,)) as pool:
+                    outcomes = list(pool.map(_startFit,jobs))
+            except (ImportError, TypeError, OSError) as err:
+                print("Process pool not available, running starts in series: ",err)
+        if outcomes is None:
+            _initStartWorker(worker)
+            outcomes = [_startFit(job) for job in jobs]
+        table = [(starts[i],)+tuple(outcomes[i][0:4]) for i in range(len(starts))]
+        best = int(np.argmin([out[1] for out in outcomes]))
+        xbest,cost,nfev,ier,mesg = outcomes[best]
+        # set up this object as for the best fit, including atten for all lines
+        self.nlines = nlines
+        self.lineStep = 1
+        self.firstLine = firstLine
+        self.prepareFit()
+        if self.context.reduced:
+            print("Reduced energy grid of ",len(self.context.xe)," points; max attenuation error at solution = ",
+                  self.gridError(xbest))
+        self.objFunSq(xbest)
+        res = (xbest,[0],{"nfev":nfev},mesg,ier)
+        return res,table
+
+    def calcResponse(self,x,lines,xe):
+        """ Return the detector response matrix, of shape (lines x energies), for
+            the given array of line numbers using the fit variables x. This is the
+            source spectrum after self absorption in the target and attenuation by
+            the filters, weighted by energy and the absorption in the detector.
+            Summing a row over energy gives the signal, i0, with no sample present.
+            For a (n x variables) batch x the result is (n x lines x energies).
+            """
+        ctx = self.getContext()
+        tw,dw,fw,ec,spectra = self.calcWidths(x,self.nlines,xe)
+        if isinstance(spectra,np.ndarray):
+            se = spectra
+        else:
+            se = ctx.spec
+        if np.ndim(se)>1:
+            se = se[...,np.newaxis,:]
+        if np.ndim(ec)>1:
+            ec = ec[...,np.newaxis,:]
+        attSum = ctx.attFixed + fw[...,lines,np.newaxis]*ctx.muFilter
+        attTar = tw[...,lines,np.newaxis]*ctx.muTarget
+        attDet = dw[...,lines,np.newaxis]*ctx.muDetector
+        # this is the key integral done as a simple sum. Can ignore width of each value
+        # as constant energy steps, so cancels in I/I0
+        return ctx.weights*se*np.exp(-attSum-attTar)*ec*(1-np.exp(-attDet))
+
+    def responseSums(self,x,lines,trans,minpt):
+        """ Return the nan free response matrix for the given lines, its sum over
+            energy, i0, and the (lines x points) sums of the response times the
+            (points x energies) transmission matrix trans, i_sample. Energies below
+            index minpt are excluded from the sums. Uses the compiled kernel if
+            engine is "numba" and numba is available, otherwise numpy.
+            """
+        ctx = self.getContext()
+        if self.engine == "numba" and haveNumba:
+            tw,dw,fw,ec,spectra = self.calcWidths(x,self.nlines,ctx.xe)
+            if isinstance(spectra,np.ndarray):
+                se = ctx.weights*spectra
+            else:
+                se = ctx.weights*ctx.spec
+            nen = len(ctx.xe)
+            resp = np.empty((len(lines),nen))
+            i0 = np.empty(len(lines))
+            i_sample = np.empty((len(lines),trans.shape[0]))
+            _forwardKernel(np.ascontiguousarray(tw[lines],dtype="double"),
+                           np.ascontiguousarray(dw[lines],dtype="double"),
+                           np.ascontiguousarray(fw[lines],dtype="double"),
+                           np.ascontiguousarray(ec,dtype="double"),
+                           np.ascontiguousarray(se,dtype="double"),
+                           ctx.muTarget,ctx.muDetector,ctx.muFilter,ctx.attFixed,
+                           np.ascontiguousarray(trans,dtype="double"),minpt,resp,i0,i_sample)
+            return resp,i0,i_sample
+        at_se = self.calcResponse(x,lines,ctx.xe)
+        # remove nan's - why are nan's present? exp overflow gives inf, multiply by 0 gives nan
+        # in most cases nans are OK to ignore, so they are zeroed before summing.
+        at_se = np.where(np.isnan(at_se),0.,at_se)
+        i0 = np.sum(at_se[:,minpt:],axis=1)
+        i_sample = np.dot(at_se[:,minpt:],trans[:,minpt:].T)
+        return at_se,i0,i_sample
+
+    def __forward(self,x):
+        """ Evaluate the forward model for the currently selected lines. Returns the
+            line numbers, the nan free response matrix and, above the low energy
+            cut, the response and the sample transmission, then i0 and i_sample.
+            Results for recent values of x are memoized; the returned arrays
+            must not be modified.
+            """
+        key = (np.asarray(x,dtype="double").tobytes(),self.nlines,self.lineStep,self.firstLine)
+        for item in self.memo:
+            if item[0] == key:
+                return item[1]
+        ctx = self.getContext()
+        minpt = ctx.minpt
+        lines = np.arange(0,self.nlines,self.lineStep)
+        at_se,i0,i_sample = self.responseSums(x,lines,ctx.trans,minpt)
+        # drop low energy terms below 10%
+        at_se_t = at_se[:,minpt:]
+        trans = ctx.trans[:,minpt:]
+        result = (lines,at_se,at_se_t,trans,i0,i_sample)
+        self.memo.insert(0,(key,result))
+        del self.memo[self.memoSize:]
+        return result
+
     def objFunSq(self,x):
-        """ The function to minimize; returns the squared error for every point on each
-            selected line  """
+        """ The function to minimize; returns the squared error, or the signed error
+            if residual is "signed", for every point on each selected line. All
+            selected lines and samples are evaluated together as the product of the
+            (lines x energies) response matrix and the transposed (samples x energies)
+            transmission matrix. Raises fitCancelled if cancelRequested has been set.
+            """
+        if self.cancelRequested:
+            raise fitCancelled("fit cancelled after "+str(self.objFnCalls)+" evaluations")
         # Get the 3 widths: target(e.g. W), detector(e.g. CsI), global filter(e.g. Cu)
         # target and detector widths depend on line number, filter is a global value
         # for flexiblity all 3 are dimesioned by nlines
         #
-        # mask out low en spectral points which may get undue weight if -ve filter widths occur
-        minpt = int(0.1*len(self.carCal.spec.getE()))
-        #
-        xe = self.carCal.spec.getE()
-        tw,dw,fw,ec,spectra = self.calcWidths(x,self.nlines,xe)
+        ctx = self.getContext()
+        xe = ctx.xe
         nsamples = self.carInfo.numSamples - 1 # ignore null sample
-        ans = np.zeros(nsamples*self.nlines)
-        tarAtt = self.carCal.targetAtten
-        if isinstance(spectra,np.ndarray):
-            se = spectra
-        else:
-            se = self.carCal.spec.getS()
-        #
-        for line in range(0,self.nlines,self.lineStep):
-            # compute filter attenuation and hence i0 as signal level with no sample for this line
-            attDet = dw[line]*self.carCal.detectorAtten.getMu()[:len(xe)]
-            attSum = np.zeros(len(xe))
-            for filt in range(self.carCal.filterCount):
-                if filt == self.varFilter:
-                    fwid = fw[line]
-                else:
-                    fwid = self.carCal.filterWidth[filt]
-                attSum = attSum + fwid*self.carCal.filterAtten[filt].getMu()[:len(xe)]
-            # this is the key integral done as a simple sum. Can ignore width of each value
-            # as constant energy steps, so cancels in I/I0
-            at_se = se*np.exp(-attSum-tarAtt.getMu()[:len(xe)]*tw[line])*ec*(1-np.exp(-attDet))
-            # drop low energy terms below 10%
-            at_se_t = at_se[minpt:]
-            # remove nan's - why are nan's present? exp overflow gives inf, multiply by 0 gives nan
-            # in most cases nans are OK to ignore.
-            at_se_finite = at_se_t[np.logical_not(np.isnan(at_se_t))]
-            i0 = np.sum(at_se_finite)
-            #
-            for sample in range(nsamples):
-                # skip masked samples
-                if self.carInfo.mask[sample]:
-                    continue
-                widSam = self.carInfo.sampWidth[sample]
-                #
-                attSam = widSam*self.carInfo.filterAtt[sample].getMu()[:len(xe)]
-                #
-                # drop low energy terms < 10%
-                at_se_sample = (at_se * np.exp(-attSam))[minpt:]
-                #
-                # remove nan's - see above
-                at_se_sample_finite = at_se_sample[np.logical_not(np.isnan(at_se_sample))]
-                i_sample = np.sum(at_se_sample_finite)
-                if i0==0. and self.verbose:
-                    print("warn: i0 zero at ",line)
-                    i0=1.
-                if i_sample == 0 and self.verbose:
-                    print("i_sample=0")
-                if i_sample < 0. and self.verbose:
-                    print("i_sample<0",at_se_sample[:8])
-                #sumSq = sumSq + ( (i_sample/i0) - self.carCal.getAvAtten(line,sample) ) ** 2
-                ans[line*nsamples+sample] = ( np.log(i0/i_sample) - self.carCal.getAvAtten(line,sample) ) ** 2
-                self.atten[line,sample] = np.log(i0/i_sample)
+        lines,at_se,at_se_t,trans,i0,i_sample = self.__forward(x)
         if self.verbose:
+            i0 = np.copy(i0)
+            if np.any(i0==0.):
+                print("warn: i0 zero at ",lines[i0==0.])
+                i0[i0==0.] = 1.
+            if np.any(i_sample==0.):
+                print("i_sample=0")
+            if np.any(i_sample<0.):
+                print("i_sample<0",at_se_t[np.any(i_sample<0.,axis=1)][0,:8])
+        att = np.log(i0[:,np.newaxis]/i_sample)
+        # skip masked samples
+        use = ctx.use
+        expt = ctx.expt[self.firstLine+lines,:]
+        ans = np.zeros((self.nlines,nsamples))
+        ans[lines[:,np.newaxis],use] = att[:,use] - expt[:,use]
+        if self.residual == "squared":
+            ans = ans ** 2
+        self.atten[self.firstLine+lines[:,np.newaxis],np.nonzero(use)[0]] = att[:,use]
+        if self.verbose:
+            tw,dw,fw,ec,spectra = self.calcWidths(x,self.nlines,xe)
             print("tw,dw,fw,sumSq: ",tw[0],dw[0],fw[0],np.sum(ans))
             # for debugging we print the normalised detector response for the current parameters
             plotFreq=10
@@ -773,29 +2101,172 @@ class fitData(object):
                 plt.figure('NormRespone')
                 plt.xlabel('energy')
                 plt.ylabel('Normalised response')
-                # map nans to zero for plotting
-                at_se[np.isnan(at_se)] = 0.
-                plt.plot(xe,at_se/i0)
+                plt.plot(xe,at_se[-1,:]/i0[-1])
                 plt.draw()
                 plt.show(block=False)
         self.objFnCalls=self.objFnCalls+1
 
         #
-        # return vector of squared errors: length=samples*lines
+        # return vector of (squared) errors: length=samples*lines, followed by
+        # the smoothing terms if fitting per line
+        if self.perLineAt is not None:
+            ans = np.concatenate((ans.ravel(),self.smoothResid(x)))
+        else:
+            ans = ans.ravel()
+        self.recordTrace(x,ans)
         return ans
 
+    def jacFunSq(self,x):
+        """ Analytic Jacobian of objFunSq, shape (lines*samples x len(x)).
+            Every fit variable enters the response R(E) for a line through a
+            factor whose log derivative, g(E), is known in closed form, so the
+            derivative of att=log(i0/i_sample) is <g>_i0 - <g>_i_sample, where
+            <> is the average weighted by the integrand of i0 or i_sample.
+            Line dependent variables are then scaled by the powers of the
+            line number used by calcWidths.
+            """
+        ctx = self.getContext()
+        xe = ctx.xe
+        minpt = ctx.minpt
+        nsamples = self.carInfo.numSamples - 1
+        lines,at_se,at_se_t,trans,i0,i_sample = self.__forward(x)
+        att = np.log(i0[:,np.newaxis]/i_sample)
+        use = ctx.use
+        expt = ctx.expt[self.firstLine+lines,:]
+        # derivative of each residual with respect to att
+        if self.residual == "squared":
+            dres = 2.*(att-expt)
+        else:
+            dres = np.ones(att.shape)
+        dres[:,np.logical_not(use)] = 0.
+        tw,dw,fw,ec,spectra = self.calcWidths(x,self.nlines,xe)
+        nt = self.vary_target+1
+        nd = self.vary_detector+1
+        nf = self.vary_filter+1
+        ne = self.vary_energy+1
+        ns = self.vary_epk+self.vary_ewidlow+self.vary_ewidhigh+3
+        jac = np.zeros((self.nlines,nsamples,len(x)))
+        lineNo = lines.astype("double")
+
+        def dAtt(g):
+            """ derivative of att given log derivative g of the response """
+            gR = g*at_se_t
+            return np.sum(gR,axis=1)[:,np.newaxis]/i0[:,np.newaxis] - np.dot(gR,trans.T)/i_sample
+
+        def setPoly(col,npoly,datt):
+            """ fill columns of a polynomial in line number, highest order first """
+            for k in range(npoly):
+                jac[lines,:,col+k] = dres*datt*(lineNo**(npoly-1-k))[:,np.newaxis]
+
+        if nt>0:
+            setPoly(0,nt,dAtt(-ctx.muTarget[minpt:]))
+        if nd>0:
+            attDet = np.outer(dw[lines],ctx.muDetector[minpt:])
+            expDet = np.exp(-attDet)
+            g = np.where(expDet<1.,attDet*expDet/(1.-expDet),1.)
+            setPoly(nt,nd,dAtt(g))
+        if nf>0 and self.varFilter>-1:
+            setPoly(nt+nd,nf,dAtt(-ctx.muFilter[minpt:]))
+        xet = xe[minpt:]
+        if ne>0:
+            for k in range(ne):
+                jac[lines,:,nt+nd+nf+k] = dres*dAtt(xet**(ne+1-k)/ec[minpt:])
+        if ns>0:
+            ip = nt+nd+nf+ne
+            above = xet>x[ip]
+            wid = np.where(above,x[ip+1],x[ip+2])
+            arg = (xet-x[ip])*wid
+            jac[lines,:,ip] = dres*dAtt(2.*arg*wid)
+            jac[lines,:,ip+1] = dres*dAtt(np.where(above,-2.*arg*(xet-x[ip]),0.))
+            jac[lines,:,ip+2] = dres*dAtt(np.where(above,0.,-2.*arg*(xet-x[ip])))
+        return jac.reshape(self.nlines*nsamples,len(x))
+
+    def batchObjFunSq(self,xs):
+        """ Return objFunSq for each row of the (n x variables) array xs, shape
+            (n x lines*samples). The model is evaluated for all rows together with
+            a leading batch axis; atten and the memo are not changed.
+            """
+        ctx = self.getContext()
+        minpt = ctx.minpt
+        nsamples = self.carInfo.numSamples - 1
+        lines = np.arange(0,self.nlines,self.lineStep)
+        at_se_t = self.calcResponse(xs,lines,ctx.xe)[...,minpt:]
+        at_se_t = np.where(np.isnan(at_se_t),0.,at_se_t)
+        i0 = np.sum(at_se_t,axis=-1)
+        i_sample = np.dot(at_se_t,ctx.trans[:,minpt:].T)
+        att = np.log(i0[...,np.newaxis]/i_sample)
+        use = ctx.use
+        expt = ctx.expt[self.firstLine+lines,:]
+        ans = np.zeros((len(xs),self.nlines,nsamples))
+        ans[:,lines[:,np.newaxis],use] = att[:,:,use] - expt[:,use]
+        if self.residual == "squared":
+            ans = ans ** 2
+        return ans.reshape(len(xs),self.nlines*nsamples)
+
+    def batchJacFunSq(self,x):
+        """ Forward difference Jacobian of objFunSq, shape (lines*samples x len(x)).
+            The N+1 vectors, x and x with each variable stepped in turn, are
+            evaluated by batchObjFunSq in one call, or split over jacThreads
+            threads if >1. Steps are as for the '2-point' Jacobian of least_squares.
+            """
+        x = np.asarray(x,dtype="double")
+        step = np.sqrt(np.finfo(float).eps)*np.where(x<0.,-1.,1.)*np.maximum(1.,np.abs(x))
+        xs = np.vstack((x,x+np.diag(step)))
+        # use the step actually represented in floating point
+        step = np.diag(xs[1:])-x
+        if self.jacThreads>1:
+            from concurrent.futures import ThreadPoolExecutor
+            # the numpy error state is per thread, so the workers are given the caller's
+            errState = np.geterr()
+            def chunk(part):
+                with np.errstate(**errState):
+                    return self.batchObjFunSq(part)
+            with ThreadPoolExecutor(max_workers=self.jacThreads) as pool:
+                parts = list(pool.map(chunk,np.array_split(xs,min(self.jacThreads,len(xs)))))
+            fvals = np.vstack(parts)
+        else:
+            fvals = self.batchObjFunSq(xs)
+        return ((fvals[1:]-fvals[0])/step[:,np.newaxis]).T
+
+    def checkJacobian(self,x):
+        """ Compare the analytic Jacobian with central finite differences at x and
+            print the largest differences for each fit variable. Returns the maximum
+            relative difference. """
+        atten = np.copy(self.atten)
+        calls = self.objFnCalls
+        jac = self.jacFunSq(x)
+        jfd = np.zeros(jac.shape)
+        for k in range(len(x)):
+            step = 1.e-6*max(abs(x[k]),1.e-2)
+            xp = np.array(x,dtype="double")
+            xm = np.array(x,dtype="double")
+            xp[k] += step
+            xm[k] -= step
+            jfd[:,k] = (self.objFunSq(xp)-self.objFunSq(xm))/(2.*step)
+        self.atten = atten
+        self.objFnCalls = calls
+        scale = np.max(np.abs(jfd),axis=0)
+        scale[scale==0.] = 1.
+        relerr = np.max(np.abs(jac-jfd),axis=0)/scale
+        print("Jacobian check: variable, max |analytic|, max rel. difference")
+        for k in range(len(x)):
+            print('{0:5d} {1:14.6e} {2:12.4e}'.format(k,np.max(np.abs(jac[:,k])),relerr[k]))
+        if np.max(relerr)>1.e-3:
+            print("** Warning: analytic Jacobian differs from finite differences")
+        return np.max(relerr)
+
     def linesPolyFit(self,soln,corMat,corEn,npoints,attrange):
         """ Function to calculate the attenuation over "npoints" for attenuation up to "attrange" for each line.
             Uses the fitted parameters for attenuation in "soln". Having calculated apparent attenuation for the correction
             material "corMat", map the observed attenuation to the true attenuation at the corEn energy. Then fit a
             polynomial to the data and save the coefficients.
+            The (points x energies) transmission of the correction material is built once, so the attenuation
+            for all lines is a single product with the (lines x energies) response matrix.
+            Row i of the results is for image line firstLine+i.
             """
         # Get the 3 widths: target(e.g. W), detector(e.g. CsI), global filter(e.g. Cu)
         # target and detector widths depend on line number, filter is a global value
         # for flexiblity all 3 are dimesioned by nlines. Also the energy parameter, if fitted.
-        xe = self.carCal.spec.getE()
-        tw,dw,fw,ec,spectra = self.calcWidths(soln,self.nlines,xe)
-        #nsamples = self.carInfo.numSamples
         # allocate space to store all calculated points and polynomials fitted to them
         attout = np.zeros(shape=(self.nlines,npoints+1))
         # set order of polynomial fits to use
@@ -804,17 +2275,11 @@ class fitData(object):
         odpoly = 8
         xtekodpoly = 3
         # determine if the solution varies with line number; if not only one fit required
-        vary_line = (self.vary_target>0 or self.vary_detector>0 or self.vary_filter>0)
+        vary_line = (self.vary_target>0 or self.vary_detector>0 or self.vary_filter>0
+                     or self.perLineAt is not None)
         #
         # find the actual attenuation of the correction material at the correction energy
         corrAtt = corMat.getMuByE(corEn)
-
-        tarAtt = self.carCal.targetAtten
-        #
-        if isinstance(spectra,np.ndarray):
-            se = spectra
-        else:
-            se = self.carCal.spec.getS()
         #
 
         # generate points to evaluate attenuation at.
@@ -833,50 +2298,29 @@ class fitData(object):
         polyfit = np.zeros(shape=(nlines,odpoly+2))
         xpolyfit = np.zeros(shape=(nlines,xtekodpoly+2))
         #
-        for line in range(nlines):
-            # compute filter attenuation and hence i0 as signal level with no sample for this line
-            attDet = dw[line]*self.carCal.detectorAtten.getMu()[:len(xe)]
-            attSum = np.zeros(len(xe))
-            for filt in range(self.carCal.filterCount):
-                if filt == self.varFilter:
-                    fwid = fw[line]
-                else:
-                    fwid = self.carCal.filterWidth[filt]
-                attSum = attSum + fwid*self.carCal.filterAtten[filt].getMu()[:len(xe)]
-            # this is the key integral done as a simple sum. Can ignore width of each value
-            # as constant energy steps, so cancels in I/I0
-            at_se = se*np.exp(-attSum-tarAtt.getMu()[:len(xe)]*tw[line])*ec*(1-np.exp(-attDet))
-            # remove nan's - why are nan's present? exp overflow gives inf, multiply by 0 gives nan
-            # in most cases nans are OK to ignore.
-            at_se_finite = at_se[np.logical_not(np.isnan(at_se))]
-            i0 = np.sum(at_se_finite)
-            #
-            count = 0
-            # loop over required attenuation values
-            for muwid in mulist:
-                attSam = muwid*corMat.getMu()[:len(xe)]
-                at_se_sample = at_se * np.exp(-attSam)
-                #
-                # remove nan's - see above
-                #  should not be needed here if fit is OK
-                at_se_sample_finite = at_se_sample[np.logical_not(np.isnan(at_se_sample))]
-                i_sample = np.sum(at_se_sample_finite)
-                if i0==0. and self.verbose:
-                    print("warn: i0 zero at ",line)
-                    i0=1.
-                if i_sample == 0 and self.verbose:
-                    print("i_sample=0")
-                if i_sample < 0. and self.verbose:
-                    print("i_sample<0",at_se_sample[:8])
-                #sumSq = sumSq + ( (i_sample/i0) - self.carCal.getAvAtten(line,sample) ) ** 2
-                attout[line,count] = np.log(i0/i_sample)
-                count = count+1
-            #
-            try:
-                polyfit[line,0:odpoly+1] = np.polyfit(attout[line,1:],attin[1:]/attout[line,1:],odpoly)
-                xpolyfit[line,0:xtekodpoly+1] = np.polyfit(attout[line,1:],attin[1:]/attout[line,1:],xtekodpoly)
-            except:
-                print("*** Polynomial fit of result failed")
+        # transmission through the correction material for each attenuation point
+        trans = np.exp(-np.outer(mulist,self.getContext().muOf(corMat)))
+        at_se,i0,i_sample = self.responseSums(soln,np.arange(nlines),trans,0)
+        if self.verbose:
+            if np.any(i0==0.):
+                print("warn: i0 zero at ",np.nonzero(i0==0.)[0])
+                i0[i0==0.] = 1.
+            if np.any(i_sample==0.):
+                print("i_sample=0")
+            if np.any(i_sample<0.):
+                print("i_sample<0")
+        attout[:nlines,:] = np.log(i0[:,np.newaxis]/i_sample)
+        # fit all lines together; lines with non-finite data are reported, not fitted
+        yfit = attin[np.newaxis,1:]/attout[:nlines,1:]
+        polyfit[:,0:odpoly+1],resid,cond = batchPolyFit(attout[:nlines,1:],yfit,odpoly)
+        xpolyfit[:,0:xtekodpoly+1],xresid,xcond = batchPolyFit(attout[:nlines,1:],yfit,xtekodpoly)
+        self.polyFitInfo = {"resid":resid, "cond":cond, "xresid":xresid, "xcond":xcond}
+        failed = np.nonzero(np.isnan(resid))[0]
+        if len(failed)>0:
+            print("*** Polynomial fit of result failed for lines: ",failed)
+        if len(failed)<nlines:
+            print("Polynomial fits: max residual = ",np.nanmax(resid),
+                  " max condition number = ",np.nanmax(cond))
         #
         # following carousel.pro, attout is the apparent attenuation or the x-axis of our correction
         # graph. the y-axis should be the actual attenuation at monochromatic energy corEn for the
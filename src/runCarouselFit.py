@@ -31,6 +31,7 @@ import os.path
 import logging
 import timeit
 import time
+import threading
 import numpy as np
 import itertools as it
 from numpy.polynomial.polynomial import polyval
@@ -49,11 +50,32 @@ markerErr = it.cycle((',', '+', '.', 'o', '*'))
 
 def loadAll(string):
     """ read both the carousel definition file and the data file with the
-        calibration data """
+        calibration data.
+        Syntax: load <cardef> <carrun> [mmap] [float32] [cache] [lines=a:b[:step]] [rows=c:d]
+        mmap memory maps the image file rather than reading it into memory, and
+        float32 holds the transformed image in single precision; both reduce the
+        memory needed for large images. cache saves the transformed image and
+        averages beside the image file, to be reused by later loads.
+        lines and rows select a region of the images, as python slices, e.g.
+        lines=0:100:5 for every fifth of the first 100 lines; only this part
+        of the image file is read and the fit is of these lines. """
     global carouselData, carouselCal, xSpec
-    if len(string)<3:
-        print("syntax: load <cardef> <carrun>")
+    if fitRunning():
         return
+    keys = dict(w.split("=",1) for w in string[3:] if "=" in w)
+    options = [w for w in string[3:] if "=" not in w]
+    syntax = "syntax: load <cardef> <carrun> [mmap] [float32] [cache] [lines=a:b[:step]] [rows=c:d]"
+    if len(string)<3 or len(set(options)-set(["mmap","float32","cache"]))>0 or \
+       len(set(keys)-set(["lines","rows"]))>0:
+        print(syntax)
+        return
+    roi = None
+    if len(keys)>0:
+        try:
+            roi = (parseSlice(keys.get("lines",":"),True), parseSlice(keys.get("rows",":"),False))
+        except ValueError:
+            print(syntax)
+            return
 
     if debug:
         pdb.set_trace()
@@ -61,10 +83,20 @@ def loadAll(string):
     if not carouselData.isValid():
         print("** failed to load carousel data")
         return
-    carouselCal = cu.carouselCalibrationData(string[2], carouselData)
+    # the image of the previous load is reused for the new one if the same size,
+    # unless a background fit may still be using it
+    previous = None
+    if carouselCal is not None and carouselCal.isValid() and backgroundJob is None:
+        previous = carouselCal.image
+    carouselCal = cu.carouselCalibrationData(string[2], carouselData, mmap="mmap" in options,
+                                             dtype="float32" if "float32" in options else "float64",
+                                             cache="cache" in options, roi=roi, out=previous)
     if not carouselCal.isValid():
         print("** failed to load calibration data")
         return
+    if carouselCal.roi is not None:
+        print("Using image region ",carouselCal.roiText())
+        logging.info('image region '+carouselCal.roiText())
     xSpec = carouselCal.spec
     # set guess for spectra peak to half the maximum X-ray voltage
     startX[4] = carouselCal.voltage/2.
@@ -77,6 +109,19 @@ def loadAll(string):
     carouselCal.printImageStats(carouselData)
 
 
+def parseSlice(text,allowStep):
+    """ Return the slice given by text of the form a:b or a:b:step, where a or b
+        may be omitted; step must be >0 and is only allowed if allowStep.
+        Raises ValueError if text is not of this form. """
+    parts = text.split(":")
+    if len(parts) < 2 or len(parts) > (3 if allowStep else 2):
+        raise ValueError
+    values = [int(v) if v!="" else None for v in parts]
+    if len(values) == 3 and values[2] is not None and values[2] < 1:
+        raise ValueError
+    return slice(*values)
+
+
 def showImg(string):
     """ plot the n calibration images on one plot; user must kill
         window to continue"""
@@ -97,6 +142,9 @@ def showSpec(string):
     """ plot spectra of source along with filtered spectra and response spectra.
         Note that these just use input data, not fitted data.
     """
+    # the fit results are not updated until a background fit is completed
+    if fitRunning():
+        return
     if carouselCal == None:
         print("must load data first")
         return
@@ -198,7 +246,8 @@ def showAtt(string):
     if carouselCal == None:
         print("must load data first")
         return
-    defline=400
+    # line 400 of a full image, or the middle line of a smaller region
+    defline=min(400, carouselCal.lines//2)
     plt.figure(FIG_ATT1D)
     if len(string)>1:
         try:
@@ -211,27 +260,30 @@ def showAtt(string):
                 defline = int(string[2])
             except:
                 print("failed to read line number")
-        if samp > -1 and samp < carouselCal.samples and defline > -1 and defline < carouselCal.lines:
-            z = carouselCal.getImage(samp)
-            plt.plot(z[defline,:])
-            plt.xlabel("Column number at line "+str(defline))
-            plt.ylabel("attenuation")
-            plt.draw()
-            plt.show(block=False)
-        else:
+                return
+        if samp < 0 or samp >= carouselCal.samples:
             print("sample number out of range")
+            return
+    if defline < 0 or defline >= carouselCal.lines:
+        print("line must be >=0 and < ",carouselCal.lines)
+        return
+    if len(string)>1:
+        z = carouselCal.getImage(samp)
+        plt.plot(z[defline,:])
     else:
         for i in range(carouselCal.samples):
             z = carouselCal.getImage(i)
             plt.plot(z[defline,:])
-        plt.xlabel("Column number at line "+str(defline))
-        plt.ylabel("attenuation")
-        plt.draw()
-        plt.show(block=False)
+    plt.xlabel("Column number at line "+str(defline))
+    plt.ylabel("attenuation")
+    plt.draw()
+    plt.show(block=False)
     return
 
 def showCor(string):
     """ plot the fitted correction curve from the polynomial data """
+    if fitRunning():
+        return
     if not 'xtab' in globals():
         print("No correction data available; run fitatt first")
         return
@@ -275,7 +327,7 @@ def showCor(string):
     count = 0
     for i in range(nsamp):
         if not carouselData.mask[i]:
-            xarr[count] = carouselCal.getAvAtten(linevals[0],i)
+            xarr[count] = carouselCal.getAvAtten(fit.firstLine+linevals[0],i)
             count = count+1
             #print("mask ",i,"t",carouselCal.getAvAtten(linevals[0],i))
     plt.plot([0.0,mymax],[0.0,mymax],'r--')
@@ -291,6 +343,8 @@ def setFilter(string):
             #print("have carouselCal - str: ",string)
             if len(string) == 3:
                 #print("try and set ",string[1:])
+                if fitRunning():
+                    return
                 try:
                     mat = string[1]
                     val = float(string[2])
@@ -312,103 +366,392 @@ def setFilter(string):
         print("no carousel data file loaded")
 
 
-def fitAtt(string):
-    """ Check necessary data has been set then fit model to carousel data.
-        Finally generate curves for attenuation over each line using the
-        correction material (corMat/corEn) and then fit a polynomial to this for
-        correction purposes.
-        """
-    global res,xtab,ytab,fit,polyfit,xpolyfit
-    # lstep is the line step; e.g. 1 for every line, 2 for every other line in fitting
-    lstep = 1
+def fitReady():
+    """ Check that the data, correction material and spectrum needed to fit
+        have been set, printing the problem if not.
+    """
     if carouselData == None or carouselCal == None:
         print("must load data first")
-        return
+        return False
     if not carouselData.valid or not carouselCal.valid:
         print("data not correctly loaded")
-        return
+        return False
     if corMat.name=="":
         print(" ** Must define corrrection material and energy using 'setcormat'")
-        return
+        return False
     # if no SpeKCalc data available, need to allow fitted spectra
     if carouselCal.spec.getS() is None and vary[4]==-1:
             print("** No spectrum is defined. Must use e.g. 'vary spectra 0'")
-            return
+            return False
+    return True
+
+def newFit():
+    """ Return a fitData object for the loaded data with the current vary
+        settings, initial values and options.
+    """
     defMat = "Cu"
-    fit = cu.fitData(carouselData, carouselCal, defMat)
-    fit.verbose = debug
+    newfit = cu.fitData(carouselData, carouselCal, defMat)
+    newfit.verbose = debug
     if debug:
         np.seterr(over='warn',invalid='warn')
     else:
         np.seterr(over='ignore',invalid='ignore')
+    newfit.vary_target = vary[0]
+    newfit.vary_detector = vary[1]
+    newfit.vary_filter = vary[2]
+    newfit.vary_energy = vary[3]
+    newfit.vary_epk = vary[4]
+    newfit.vary_ewidlow = vary[5]
+    newfit.vary_ewidhigh = vary[6]
+    newfit.defaults = startX
+
+    newfit.solver = solverChoice
+    newfit.jacobian = jacChoice
+    newfit.jacThreads = jacThreads
+    newfit.energyBins = energyBins
+    newfit.engine = engineChoice
+    newfit.lineMode = lineMode
+    newfit.smooth = smoothWeight
+    newfit.residual = residualChoice
+    newfit.solverOptions = dict(solverOptions)
+    return newfit
+
+def startValues():
+    """ Return the initial values of the fit variables for the current vary
+        settings and a list of the offsets of the zero order terms.
+    """
+    x = np.zeros(7+np.sum(vary))
+    # The fit function consists of 3 polynomial expressions in the
+    # the line number, plus a possible polynomial in the energy.
+    # Initial values for the zero order terms are
+    # given here, the higher terms (if any) are set to zero.
+    # Updated to allow any of the variables to be excluded from the fit (-1)
+    # In this case the initial value, in startX, should be used, which is passed
+    # to fit.
+    # startIndex records where each initial value is placed
+    startIndex = []
+    offset = vary[0]
+    if vary[0]>-1:
+        x[offset] = startX[0]
+        startIndex.append(offset)
+    offset = offset+1+vary[1]
+    if vary[1]>-1:
+        x[offset] = startX[1]
+        startIndex.append(offset)
+    offset = offset+1+vary[2]
+    if vary[2]>-1:
+        x[offset] = startX[2]
+        startIndex.append(offset)
+    offset = offset+2+vary[3]+vary[4]
+    if vary[4]>-1:
+        x[offset] = startX[4]
+        startIndex.append(offset)
+    offset = offset+1+vary[5]
+    if vary[5]>-1:
+        x[offset] = startX[5]
+        startIndex.append(offset)
+    offset = offset+1+vary[6]
+    if vary[6]>-1:
+        x[offset] = startX[6]
+        startIndex.append(offset)
+    return x,startIndex
+
+def lineErrors(fitted,firstLine,nlines):
+    """ Return the sum of squared errors in attenuation over the unmasked
+        samples for each of nlines image lines from firstLine, for the
+        attenuation of the fitData object fitted.
+    """
+    use = np.logical_not(carouselData.mask[:carouselCal.samples])
+    err = fitted.atten[firstLine:firstLine+nlines,:carouselCal.samples] - \
+          carouselCal.getAvAttenArray()[:,firstLine:firstLine+nlines].T
+    return np.sum(err[:,use]**2,axis=1)
+
+def compareResidual(string):
+    """ Fit with the legacy squared residuals and with signed residuals in turn,
+        then compare the number of evaluations, time and final error.
+        Syntax: compareres nlines [linestep]
+        The fits are run as fitatt with the current settings, but no results
+        are written and the current fit is not changed.
+    """
+    if fitRunning() or not fitReady():
+        return
+    if lineMode == "perline":
+        print("compareres is not available with linemode=perline, which uses signed residuals")
+        return
+    if np.max(vary)<0:
+        print("** Error: no parameters to fit, check setvary")
+        return
+    try:
+        nlines = int(string[1])
+        lstep = 1
+        if len(string) == 3:
+            lstep = int(string[2])
+        if len(string) > 3 or nlines < 1 or nlines > carouselCal.lines or lstep < 1:
+            raise ValueError
+    except (ValueError, IndexError):
+        print("syntax: compareres nlines [linestep] with nlines 1 to ",carouselCal.lines)
+        return
+    x,startIndex = startValues()
+    table = []
+    for mode in ("squared","signed"):
+        trial = newFit()
+        trial.residual = mode
+        t0 = timeit.default_timer()
+        try:
+            trialres,cov,infodict,mesg,ier = trial.dofit(nlines,lstep,x)
+        except Exception as experr:
+            print("** Fit failed due to exception: ",experr)
+            return
+        tim = timeit.default_timer()-t0
+        lsumsq = lineErrors(trial,0,nlines)
+        table.append((mode,infodict["nfev"],tim,np.mean(lsumsq),np.max(lsumsq),ier))
+    print("residual     nfev      time   average error     max error  ret")
+    for row in table:
+        print('{0:8s} {1:8d} {2:9.3f} {3:15.6e} {4:13.6e} {5:4d}'.format(*row))
+        logging.info('compareres {0} nlines={1} lstep={2} nfev={3} time={4:.3f} ave={5:.6e} max={6:.6e}'.format(
+            row[0],nlines,lstep,row[1],row[2],row[3],row[4]))
+
+def warmStart(previous,x,nlines,lstep,firstLine):
+    """ Return the solution of the fitData object previous as the initial values
+        for a fit of nlines lines from firstLine with step lstep by the current
+        fit, if it has the same vary settings and line mode and, for a per line
+        fit, fitted the same lines; otherwise return x. The second value returned
+        is True if the solution was used.
+    """
+    if previous is None or previous.solution is None:
+        print("No previous fit, starting from the initial values")
+        return x,False
+    if previous.lineMode != fit.lineMode or \
+       not np.array_equal(previous.varyOrders(),fit.varyOrders()) or \
+       (fit.lineMode == "perline" and (previous.perLineAt is None or previous.firstLine != firstLine or
+                                       not np.array_equal(previous.perLineAt,np.arange(0,nlines,lstep)))):
+        print("Vary settings or fitted lines changed, starting from the initial values")
+        return x,False
+    print("Starting from the solution of the previous fit")
+    return np.array(previous.solution,dtype="double"),True
+
+def refit(string):
+    """ Repeat the last fitatt, or fitatt with the given arguments, starting from
+        the solution of the last fit rather than the initial values; e.g. after
+        a change to the mask, width or filters.
+        Syntax: refit [nlines [linestep] [options as fitatt]]
+        Averages and other values that the changes do not affect are reused.
+    """
+    if len(string) > 1:
+        fitAtt(["fitatt"]+string[1:],warm=True)
+    elif lastFitArgs is None:
+        print("no previous fit; use fitatt")
+    else:
+        fitAtt(lastFitArgs,warm=True)
+
+def fitAtt(string,warm=False):
+    """ Check necessary data has been set then fit model to carousel data.
+        Finally generate curves for attenuation over each line using the
+        correction material (corMat/corEn) and then fit a polynomial to this for
+        correction purposes.
+        Syntax: fitatt nlines [linestep] [start=line] [shard=k/n]
+                       [starts=n] [sampling=lhs|grid] [spread=s] [workers=n]
+                       [schedule=s1,s2,...] [resume=checkpoint]
+        start offsets the fitted lines to begin at that image line. shard=k/n fits
+        only the k'th (from 0) of n contiguous blocks of those lines. If either is
+        used the results are written to files labelled by the line range, which
+        can be combined with "mergefits".
+        starts=n runs a multi-start fit from n points about the initial guess,
+        each zero order term varying by up to a fraction "spread" (default 0.5),
+        on "workers" processes (default all cores); the best fit is used.
+        schedule gives a list of decreasing line steps, e.g. schedule=20,5,1; the
+        fit is repeated at each step, starting from the previous solution.
+        resume starts from the best point saved in a checkpoint file, written
+        during a fit if enabled with "setoptions checkpoint=n[,t]". This is
+        refused if the input files, vary settings or mask have changed.
+        If warm is set the fit starts from the solution of the previous fit,
+        see refit.
+        """
+    global fit, lastFitArgs
+    if fitRunning():
+        return
+    args = [w for w in string if not w.startswith("resume=")]
+    # lstep is the line step; e.g. 1 for every line, 2 for every other line in fitting
+    lstep = 1
+    # keyword arguments may be given in any position after the command
+    keys = dict(w.split("=",1) for w in string[1:] if "=" in w)
+    string = [w for w in string if "=" not in w]
+    firstLine = 0
+    shard = None
+    try:
+        if "start" in keys:
+            firstLine = int(keys.pop("start"))
+        if "shard" in keys:
+            shard = [int(v) for v in keys.pop("shard").split("/")]
+            if len(shard) != 2 or shard[0] < 0 or shard[0] >= shard[1]:
+                raise ValueError
+    except ValueError:
+        print("Wrong arguments: need start=line and shard=k/n with 0<=k<n")
+        return
+    try:
+        nstarts = int(keys.pop("starts","1"))
+        spread = float(keys.pop("spread","0.5"))
+        workers = keys.pop("workers",None)
+        if workers is not None:
+            workers = int(workers)
+        sampling = keys.pop("sampling","lhs")
+        if nstarts < 1 or sampling not in ("lhs","grid"):
+            raise ValueError
+    except ValueError:
+        print("Wrong arguments: need starts=n, spread=s, workers=n and sampling=lhs|grid")
+        return
+    schedule = None
+    resume = keys.pop("resume",None)
+    if "schedule" in keys:
+        try:
+            schedule = [int(v) for v in keys.pop("schedule").split(",")]
+            if min(schedule) < 1:
+                raise ValueError
+        except ValueError:
+            print("Wrong arguments: need schedule=s1,s2,... with line steps >= 1")
+            return
+        if nstarts > 1 or sampling == "grid":
+            print("schedule can not be combined with a multi-start fit")
+            return
+    if len(keys)>0:
+        print("Unknown fitatt option(s): ",list(keys))
+        return
+    if lineMode == "perline" and (schedule is not None or nstarts > 1 or sampling == "grid"):
+        print("schedule and multi-start fits are not available with linemode=perline")
+        return
+    if not fitReady():
+        return
+    fit = newFit()
 
     if np.max(vary)<0:
         print("** Error: no parameters to fit, check setvary")
         return
-    x = np.zeros(7+np.sum(vary))
     if len(string) == 2 or len(string) == 3:
         print("Fitting variables: ",np.sum(vary)+len(vary))
-        # The fit function consists of 3 polynomial expressions in the
-        # the line number, plus a possible polynomial in the energy.
-        # Initial values for the zero order terms are
-        # given here, the higher terms (if any) are set to zero.
-        # Updated to allow any of the variables to be excluded from the fit (-1)
-        # In this case the initial value, in startX, should be used, which is passed
-        # to fit.
-        offset = vary[0]
-        if vary[0]>-1:
-            x[offset] = startX[0]
-        offset = offset+1+vary[1]
-        if vary[1]>-1:
-            x[offset] = startX[1]
-        offset = offset+1+vary[2]
-        if vary[2]>-1:
-            x[offset] = startX[2]
-        offset = offset+2+vary[3]+vary[4]
-        if vary[4]>-1:
-            x[offset] = startX[4]
-        offset = offset+1+vary[5]
-        if vary[5]>-1:
-            x[offset] = startX[5]
-        offset = offset+1+vary[6]
-        if vary[6]>-1:
-            x[offset] = startX[6]
-        fit.defaults = startX
+        x,startIndex = startValues()
         try:
             nlines = int(string[1])
             if len(string) == 3:
                 lstep = int(string[2])
         except:
-            print("Wrong arguments: fitatt nlines [linestep]")
+            print("Wrong arguments: fitatt nlines [linestep] [start=line] [shard=k/n]")
             return
     else:
-        print("wrong number of args: need fitatt nlines [linestep]")
+        print("wrong number of args: need fitatt nlines [linestep] [start=line] [shard=k/n]")
         print("where nlines=number of lines to fit and lstep is step between")
         print("lines, default 1")
         return
-    if nlines < 1 or nlines > carouselCal.lines:
-        print("fit lines out of range, must be 1 to ",carouselCal.lines)
+    if firstLine < 0 or nlines < 1 or firstLine+nlines > carouselCal.lines:
+        print("fit lines out of range, start+nlines must be 1 to ",carouselCal.lines)
         return
-    fit.vary_target = vary[0]
-    fit.vary_detector = vary[1]
-    fit.vary_filter = vary[2]
-    fit.vary_energy = vary[3]
-    fit.vary_epk = vary[4]
-    fit.vary_ewidlow = vary[5]
-    fit.vary_ewidhigh = vary[6]
+    # results are labelled by line range if only part of the image is fitted
+    suffix = ""
+    if shard is not None:
+        first = firstLine+(nlines*shard[0])//shard[1]
+        nlines = firstLine+(nlines*(shard[0]+1))//shard[1]-first
+        firstLine = first
+        if nlines < 1:
+            print("shard contains no lines")
+            return
+    if shard is not None or firstLine > 0:
+        suffix = "_lines{0:d}-{1:d}".format(firstLine,firstLine+nlines-1)
+        print("Fitting image lines ",firstLine," to ",firstLine+nlines-1)
+    lastFitArgs = args
+    # set if x holds the values of a per line fit rather than polynomials
+    perLineX = False
+    if warm:
+        x,perLineX = warmStart(lastFit,x,nlines,lstep,firstLine)
+        if lastFit is not None:
+            fit.previousContext = lastFit.context
+    if checkpointEvals > 0 or checkpointSeconds > 0.:
+        fit.checkpointFile = "fit"+suffix+".ckpt.npz"
+        fit.checkpointEvals = checkpointEvals
+        fit.checkpointSeconds = checkpointSeconds
+    if resume is not None:
+        try:
+            ckpt = cu.readCheckpoint(resume)
+        except (IOError, OSError, KeyError, ValueError) as err:
+            print("** failed to read checkpoint file ",resume,": ",err)
+            return
+        problems = fit.checkResume(ckpt,nlines,lstep,firstLine)
+        if len(problems) > 0:
+            print("** Refusing to resume from ",resume,":")
+            for problem in problems:
+                print("   ",problem)
+            return
+        x = np.array(ckpt["x"],dtype="double")
+        perLineX = fit.lineMode == "perline"
+        fit.defaults = np.array(ckpt["defaults"],dtype="double")
+        print("Resuming from ",resume,": cost = ",float(ckpt["cost"])," after ",
+              int(ckpt["nfev"])," evaluations")
+    # settings used to report the fit, taken now in case they change before a
+    # background fit finishes
+    inputs = {"corMat":corMat, "corEn":corEn, "mask":np.copy(carouselData.mask),
+              "width":carouselCal.width, "store":resultStore}
+    # a repeated fit is taken from the result cache; multi-start fits from random
+    # points are not repeatable so are not cached
+    cacheKey = None
+    if resultStore is not None and not (nstarts > 1 and sampling == "lhs"):
+        cacheKey = fit.inputKey({"x":x, "defaults":fit.defaults, "nlines":nlines, "lstep":lstep,
+                                 "firstLine":firstLine, "schedule":schedule, "nstarts":nstarts,
+                                 "sampling":sampling, "spread":spread, "corMat":inputs["corMat"],
+                                 "corEn":inputs["corEn"],
+                                 "program":cu.fileHash(os.path.splitext(os.path.abspath(__file__))[0]+".py")})
+        cached = resultStore.get(cacheKey)
+        if cached is not None:
+            print("Using cached fit result ",cacheKey)
+            fit.restoreFitState(cached)
+            cov = cached["cov"] if cached["cov"].size > 0 else None
+            result = (cached["res"],cov,{"nfev":int(cached["nfev"])},str(cached["mesg"]),int(cached["ier"]))
+            finishFit(result,float(cached["time"]),x,nlines,firstLine,suffix,inputs,cached=cached)
+            return
 
-    fit.solver = solverChoice
+    def runFit():
+        """ run the fit selected by the arguments, returning the dofit result """
+        if nstarts > 1 or sampling == "grid":
+            starts = cu.multiStartPoints(x,startIndex,nstarts,spread,sampling)
+            print("Multi-start fit from ",len(starts)," points")
+            result,table = fit.multiStartFit(nlines,lstep,starts,firstLine,workers)
+            writeMultiStart(table,startIndex)
+        elif schedule is not None:
+            result,levels = fit.scheduleFit(nlines,schedule,x,firstLine)
+            print("level  step     time     nfev  ret")
+            for i,(step,ltim,nfev,lier) in enumerate(levels):
+                print('{0:5d} {1:5d} {2:9.3f} {3:7d} {4:4d}'.format(i,step,ltim,nfev,lier))
+        else:
+            result = fit.dofit(nlines,lstep,x,firstLine,perLineX=perLineX)
+        return result
 
-    t0 = timeit.default_timer()
+    def finish(result,tim):
+        finishFit(result,tim,x,nlines,firstLine,suffix,inputs,cacheKey)
 
+    if backgroundChoice == "on":
+        startBackground(fit,runFit,finish)
+        return
+    t0 = timeit.default_timer()
     try:
-        res,cov,infodict,mesg,ier = fit.dofit(nlines,lstep,x)
+        result = runFit()
+    except KeyboardInterrupt:
+        print("** Fit interrupted")
+        return
     except Exception as experr:
         print("** Fit failed due to exception: ",experr)
         return
-    
-    tim = timeit.default_timer()-t0
+    finishFit(result,timeit.default_timer()-t0,x,nlines,firstLine,suffix,inputs,cacheKey)
 
+def finishFit(result,tim,x,nlines,firstLine,suffix,inputs,cacheKey=None,cached=None):
+    """ Report the result of a fit made by fitatt in time tim from initial values x;
+        write the fit and parameter logs, generate and save the polynomial fits for
+        the correction and plot the errors. Must be called on the main thread.
+        inputs holds the correction material and energy, mask, width and result
+        cache as they were when the fit started, which are used here.
+        The result is saved in the result cache under cacheKey if given; if cached
+        is given it is a cache entry from which the polynomial fits are taken.
+        """
+    global res,xtab,ytab,polyfit,xpolyfit,lastFit
+    res,cov,infodict,mesg,ier = result
+    fit.solution = res
+    lastFit = fit
     print("time=",tim)
     print("dofit returned: ")
     print(" best fit values = ",res)
@@ -419,9 +762,14 @@ def fitAtt(string):
         print("   Fit warning: ret=",ier)
         print("   message=",mesg)
     print(" iterations = ",infodict["nfev"])
-    # measure error
+    # measure error, against the averages for the width that was fitted
     samples = carouselCal.samples
-    ofile = open('fit.log','w')
+    mask = inputs["mask"]
+    width = carouselCal.width
+    carouselCal.setWidthAve(inputs["width"])
+    observed = carouselCal.getAvAttenArray()
+    carouselCal.setWidthAve(width)
+    ofile = open('fit'+suffix+'.log','w')
     ofile.write('time={0:12.6f}\n'.format(tim))
     ofile.write('dofit returned: ')
     ofile.write(' best fit values = \n')
@@ -431,8 +779,13 @@ def fitAtt(string):
     ofile.write(' cov = ')
     ofile.write(str(cov)+'\n')
     ofile.write(' mesg = '+mesg+'\n')
-    rfile = open('param.log','w')
+    rfile = open('param'+suffix+'.log','w')
     rfile.write('fit input: lines={0:5d}\n'.format(nlines))
+    if carouselCal.roi is not None:
+        rfile.write('image region: '+carouselCal.roiText()+'\n')
+        ofile.write(' image region: '+carouselCal.roiText()+'\n')
+    if suffix:
+        rfile.write('first line={0:5d}\n'.format(firstLine))
     rfile.write('guess: ')
     rfile.write(str(x))
     rfile.write('\n')
@@ -446,20 +799,29 @@ def fitAtt(string):
     # polynomial fit to these curves for each line.
     attLnWid = 14.0
     attPts = 300
-    xtab,ytab,polyfit,xpolyfit = fit.linesPolyFit(res,corMat,corEn,attPts,attLnWid)
+    if cached is None:
+        xtab,ytab,polyfit,xpolyfit = fit.linesPolyFit(res,inputs["corMat"],inputs["corEn"],attPts,attLnWid)
+    else:
+        xtab,ytab,polyfit,xpolyfit = [cached[name] for name in ("xtab","ytab","polyfit","xpolyfit")]
+    if cacheKey is not None:
+        covArr = cov if isinstance(cov,np.ndarray) else np.zeros(0)
+        inputs["store"].put(cacheKey,res=res,cov=covArr,nfev=infodict["nfev"],mesg=str(mesg),ier=ier,
+                        time=tim,xtab=xtab,ytab=ytab,polyfit=polyfit,xpolyfit=xpolyfit,
+                        **fit.fitState())
     # find average and max error for each line
     rfile.write('polyfits '+str(polyfit.shape[0])+" "+str(polyfit.shape[1])+"\n")
     lsumsq = []
     avatt = np.zeros((2,samples))
     for line in range(nlines):
         sumsq = 0.
+        imline = firstLine+line
         for sample in range(samples):
-            if carouselData.mask[sample]:
+            if mask[sample]:
                 continue
-            sumsq += (fit.atten[line,sample] - carouselCal.getAvAtten(line,sample) ) ** 2
+            sumsq += (fit.atten[imline,sample] - observed[sample,imline] ) ** 2
             if line==0:
-                avatt[0,sample] = carouselCal.getAvAtten(line,sample)
-                avatt[1,sample] = fit.atten[line,sample]
+                avatt[0,sample] = observed[sample,imline]
+                avatt[1,sample] = fit.atten[imline,sample]
         ofile.write(' {0:5d}  {1:12.6f}\n'.format(line,sumsq))
         lsumsq.append(sumsq)
         sumtot += sumsq
@@ -474,10 +836,15 @@ def fitAtt(string):
     rfile.write('xpoly:\n')
     for line in range(len(xpolyfit[:,0])):
         rfile.write('{0:5d} '.format(line)+str(xpolyfit[line,:])+'\n')
-    # write data in binary file
-    bfile = open("polyfit.npz","wb")
-    np.save(bfile,polyfit)
-    bfile.close()
+    # write data in binary file; partial fits also record the lines covered
+    if suffix:
+        np.savez("polyfit"+suffix+".npz",polyfit=polyfit,xpolyfit=xpolyfit,
+                 firstLine=firstLine,nlines=nlines,solution=res,roi=carouselCal.roiText())
+        print("wrote polyfit"+suffix+".npz; combine partial fits with mergefits")
+    else:
+        bfile = open("polyfit.npz","wb")
+        np.save(bfile,polyfit)
+        bfile.close()
     #
     print("average error: ",sumtot/nlines)
     print("max error: ",summax)
@@ -509,9 +876,175 @@ def fitAtt(string):
     ofile.close()
     rfile.close()
 
+def startBackground(fitobj,run,finish):
+    """ Run the fit function run() on a worker thread for the fitData object fitobj.
+        The result is passed to finish(result,time) on the main thread by fitwait,
+        or before the next command once the fit is done.
+    """
+    global backgroundJob
+    job = {"fit":fitobj, "t0":timeit.default_timer(), "result":None, "error":None,
+           "time":0., "finish":finish}
+    # numpy error handling is per thread, so use that set by newFit
+    errState = np.geterr()
+
+    def target():
+        try:
+            with np.errstate(**errState):
+                job["result"] = run()
+        except Exception as experr:
+            # includes cu.fitCancelled after fitcancel
+            job["error"] = experr
+        job["time"] = timeit.default_timer()-job["t0"]
+
+    job["thread"] = threading.Thread(target=target)
+    job["thread"].daemon = True
+    backgroundJob = job
+    job["thread"].start()
+    print("Fit running in background; use fitstatus, fitwait or fitcancel")
+
+def fitRunning():
+    """ True, with a message, if a background fit has not yet been completed """
+    if backgroundJob is not None:
+        print("A background fit is running; use fitwait or fitcancel first")
+        return True
+    return False
+
+def completeBackground(wait):
+    """ Complete the background fit, if any, once it has finished: report the
+        result or error and clear it. If wait, first wait for it to finish;
+        Ctrl-C stops waiting but leaves the fit running.
+    """
+    global backgroundJob
+    job = backgroundJob
+    if job is None:
+        return
+    if wait:
+        try:
+            while job["thread"].is_alive():
+                job["thread"].join(0.5)
+        except KeyboardInterrupt:
+            print("** stopped waiting; fit still running")
+            return
+    elif job["thread"].is_alive():
+        return
+    backgroundJob = None
+    if isinstance(job["error"],cu.fitCancelled):
+        print("** Background fit cancelled: ",job["error"])
+    elif job["error"] is not None:
+        print("** Fit failed due to exception: ",job["error"])
+    else:
+        print("Background fit finished")
+        job["finish"](job["result"],job["time"])
+
+def fitStatus(words):
+    """ Report the progress of a background fit: function evaluations, current
+        and best cost and elapsed time.
+    """
+    job = backgroundJob
+    if job is None:
+        print("No background fit")
+        return
+    fitobj = job["fit"]
+    trace = list(fitobj.trace)
+    state = "running" if job["thread"].is_alive() else "finished"
+    if fitobj.cancelRequested and state=="running":
+        state = "cancelling"
+    print("fit ",state,": evaluations = ",fitobj.objFnCalls,
+          " elapsed = {0:.1f}s".format(timeit.default_timer()-job["t0"]))
+    if len(trace)>0:
+        best = min(t[1] for t in trace)
+        print(" current cost = {0:12.5e}  best cost = {1:12.5e}".format(trace[-1][1],best))
+
+def fitCancel(words):
+    """ Cancel a background fit; it stops at the next function evaluation """
+    job = backgroundJob
+    if job is None:
+        print("No background fit")
+        return
+    job["fit"].cancelRequested = True
+    print("Cancel requested; multi-start fits stop once the running starts finish")
+    completeBackground(True)
+
+def fitWait(words):
+    """ Wait for a background fit to finish and report its result """
+    if backgroundJob is None:
+        print("No background fit")
+        return
+    completeBackground(True)
+
+def mergeFits(words):
+    """ Combine the polyfit files written by fitatt for partial line ranges into
+        one file indexed by image line, in the format of polyfit.npz. The ranges
+        must be contiguous and not overlap.
+        Syntax: mergefits <output> <file1> [file2 ...]
+        File names may include wildcards, e.g. mergefits polyfit.npz polyfit_lines*.npz
+    """
+    import glob
+    if len(words)<3:
+        print("syntax: mergefits <output> <file1> [file2 ...]")
+        return
+    files = []
+    for pattern in words[2:]:
+        found = sorted(glob.glob(pattern))
+        if len(found)==0:
+            print("** no files match ",pattern)
+            return
+        files.extend(found)
+    parts = []
+    for name in files:
+        try:
+            with np.load(name) as data:
+                roi = str(data["roi"]) if "roi" in data.files else ""
+                parts.append((int(data["firstLine"]),int(data["nlines"]),data["polyfit"],name,roi))
+        except (IOError, KeyError, ValueError):
+            print("** failed to read partial fit file ",name)
+            return
+    if len(set(part[4] for part in parts)) > 1:
+        print("** partial fits are of different image regions: ",sorted(set(part[4] for part in parts)))
+        return
+    parts.sort(key=lambda part: part[0])
+    nextLine = parts[0][0]
+    rows = []
+    for first,nlines,poly,name,roi in parts:
+        if first < nextLine:
+            print("** line ",first," is covered by more than one file, at ",name)
+            return
+        elif first > nextLine:
+            print("** lines ",nextLine," to ",first-1," missing before ",name)
+            return
+        # a fit with no line dependence gives one row for all its lines
+        if len(poly[:,0]) == 1:
+            poly = np.repeat(poly,nlines,axis=0)
+        rows.append(poly[:nlines,:])
+        nextLine = first+nlines
+    merged = np.concatenate(rows)
+    if parts[0][0] != 0:
+        print("Warning: first row of ",words[1]," is image line ",parts[0][0])
+    bfile = open(words[1],"wb")
+    np.save(bfile,merged)
+    bfile.close()
+    print("merged ",len(files)," files for lines ",parts[0][0]," to ",nextLine-1," into ",words[1])
+
+def writeMultiStart(table,startIndex):
+    """ print the outcome of each fit of a multi-start set, and save it in
+        multistart.log, marking the best """
+    best = int(np.argmin([row[2] for row in table]))
+    mfile = open('multistart.log','w')
+    print("start  sq error     nfev  ret  initial values")
+    for i,(xstart,xsol,cost,nfev,ier) in enumerate(table):
+        line = '{0:5d} {1:12.5e} {2:6d} {3:4d}  {4}'.format(i,cost,nfev,ier,xstart[startIndex])
+        if i == best:
+            line = line+'  <- best'
+        print(line)
+        mfile.write(line+'\n')
+        mfile.write('      solution: '+str(xsol)+'\n')
+    mfile.close()
+
 def initGuess(words):
     """ Set initial values to use for the variables of the target absortion width, detector
     width and filter width """
+    if len(words)>1 and fitRunning():
+        return
     try:
         startX[0] = float(words[1])
         startX[1] = float(words[2])
@@ -533,6 +1066,8 @@ def initGuess(words):
 def setWidth(words):
     """ set the half width of area along row to be averaged"""
     if len(words)>1:
+        if fitRunning():
+            return
         try:
             width = float(words[1])
             carouselCal.width = width
@@ -585,6 +1120,8 @@ def setVary(strlst):
         print("spectra: ",vary[4])
         return
     if len(strlst)==3:
+        if fitRunning():
+            return
         try:
             npo = int(strlst[2])
         except:
@@ -647,6 +1184,8 @@ def setCorMat(words):
         using the program xcom. Without arguments, list current setting, if any."""
     global corMat,corEn
     if len(words)>2:
+        if fitRunning():
+            return
         name = words[1]
         try:
             corEn = float(words[2])
@@ -662,9 +1201,16 @@ def setCorMat(words):
     name = words[1]
     print("reading correction material definition from file: ",name)
     try:
-        corMat = cu.materialAtt(name,1.0)
+        corMat = cu.getMaterialAtt(name,1.0)
     except:
         print("error reading material type")
+        return
+    if corMat.isValid():
+        try:
+            corMat.getMuByE(corEn)
+        except ValueError as err:
+            print("** ",err)
+            corMat = cu.materialAtt("",1.0)
 
 def mask(words):
     """ show or set a mask array which is used to define if some of the sample data
@@ -676,6 +1222,8 @@ def mask(words):
         return
     if len(words) == 1:
         print("Mask = ",carouselData.mask)
+    elif fitRunning():
+        return
     elif words[1] == "off":
         carouselData.mask.fill(False)
     else:
@@ -701,6 +1249,8 @@ def transform(words):
         print(" data I to log(I0/I), in the case where only I is provided. Now redundant")
         print(" as uint16 data is assumed to include I0 image at start and transform applied.")
         return
+    if fitRunning():
+        return
     I0 = float(words[1])
     nsamp = len(carouselData.mask)-1
     for i in range(nsamp):
@@ -712,23 +1262,225 @@ def transform(words):
         z = np.log(z)
         z = np.log(I0) - z
         carouselCal.getImage(i)[:,:] = z
+    carouselCal.clearAvAtten()
 
 def setOptions(words):
-    """ Set options controlling the fit process. Currently just select between the new and old
-        versions of the least squares solver.
+    """ Set options controlling the fit process. Select between the new and old
+        versions of the least squares solver and the Jacobian used by them:
+        jac=numeric uses finite differences, jac=analytic the closed form
+        derivatives and jac=check compares the two before fitting with analytic.
+        jac=batch uses finite differences evaluated together in one call, split
+        over n threads if threads=n is set.
+        egrid=n evaluates the model on a reduced grid of about n energies,
+        egrid=full (or 0) on the full grid of the spectrum.
+        engine=numba evaluates the forward model with a compiled kernel, if
+        numba is installed, engine=numpy with numpy.
+        linemode=perline fits the target and detector widths separately for each
+        fitted line, coupled to neighbouring lines with weight smooth=s, using
+        the new solver with a sparse Jacobian and signed residuals; linemode=poly
+        fits polynomials.
+        residual=signed returns the signed differences in attenuation to the
+        solvers, residual=squared the legacy squared differences.
+        The solver controls ftol, xtol, gtol, max_nfev, x_scale, diff_step, loss,
+        tr_solver and verbose are given as for scipy least_squares, e.g. ftol=1e-6,
+        x_scale=jac or x_scale=0.01,1,0.01; name=default removes the setting.
+        leastsq (solver=old) uses the equivalent controls, except loss, tr_solver
+        and verbose.
+        background=on runs fitatt on a worker thread, leaving the prompt free.
+        checkpoint=n[,t] saves the best point of a fit every n evaluations and, if
+        t is given, every t seconds to fit.ckpt.npz (fit_lines<a>-<b>.ckpt.npz for
+        partial fits), for "fitatt ... resume=<file>"; checkpoint=off disables this.
+        cache=on reuses the result of a repeated fitatt with identical inputs from
+        the result cache, cache=off disables it; cachesize=MB limits its size.
     """
-    global solverChoice
+    global solverChoice, jacChoice, jacThreads, energyBins, engineChoice
+    global lineMode, smoothWeight, residualChoice, backgroundChoice
+    global checkpointEvals, checkpointSeconds, resultStore, cacheMBytes
+    name = words[1].split("=",1)[0] if len(words)>1 else ""
     if len(words)<2:
         print("Options:")
         print(" solver = ",solverChoice)
+        print(" jac = ",jacChoice)
+        print(" threads = ",jacThreads)
+        print(" egrid = ",energyBins if energyBins>0 else "full")
+        print(" engine = ",engineChoice)
+        print(" linemode = ",lineMode)
+        print(" smooth = ",smoothWeight)
+        print(" residual = ",residualChoice)
+        print(" background = ",backgroundChoice)
+        if checkpointEvals > 0 or checkpointSeconds > 0.:
+            print(" checkpoint = ",checkpointEvals," evaluations, ",checkpointSeconds," seconds")
+        else:
+            print(" checkpoint = off")
+        print(" cache = ","off" if resultStore is None else "on")
+        print(" cachesize = ",cacheMBytes)
+        for key in sorted(solverOptions):
+            print(" "+key+" = ",solverOptions[key])
     elif words[1]=="solver=new":
         solverChoice="new"
     elif words[1]=="solver=old":
         solverChoice="old"
+    elif words[1] in ("jac=numeric","jac=analytic","jac=check","jac=batch"):
+        jacChoice=words[1][4:]
+    elif words[1].startswith("threads="):
+        try:
+            jacThreads = max(0,int(words[1][8:]))
+        except ValueError:
+            print("threads requires an integer")
+    elif words[1].startswith("egrid="):
+        try:
+            if words[1]=="egrid=full":
+                energyBins = 0
+            else:
+                energyBins = max(0,int(words[1][6:]))
+        except ValueError:
+            print("egrid requires an integer number of energies or 'full'")
+    elif words[1].startswith("checkpoint="):
+        try:
+            if words[1]=="checkpoint=off":
+                checkpointEvals,checkpointSeconds = 0,0.
+            else:
+                values = words[1][11:].split(",")
+                if len(values) > 2:
+                    raise ValueError
+                evals = int(values[0])
+                seconds = float(values[1]) if len(values)==2 else 0.
+                if evals < 0 or seconds < 0. or (evals == 0 and seconds == 0.):
+                    raise ValueError
+                checkpointEvals,checkpointSeconds = evals,seconds
+        except ValueError:
+            print("checkpoint requires n[,t] evaluations and seconds, or 'off'")
+    elif words[1] in ("cache=on","cache=off"):
+        resultStore = None
+        if words[1]=="cache=on":
+            resultStore = cu.resultCache(CACHE_DIR,cacheMBytes*2**20)
+    elif words[1].startswith("cachesize="):
+        try:
+            cacheMBytes = float(words[1][10:])
+            if cacheMBytes <= 0.:
+                raise ValueError
+        except ValueError:
+            print("cachesize requires a size in MB > 0")
+            cacheMBytes = 500.
+        if resultStore is not None:
+            resultStore.maxBytes = cacheMBytes*2**20
+            resultStore.evict()
+    elif words[1] in ("background=on","background=off"):
+        backgroundChoice=words[1][11:]
+    elif words[1] in ("residual=signed","residual=squared"):
+        residualChoice=words[1][9:]
+    elif words[1] in ("linemode=perline","linemode=poly"):
+        lineMode=words[1][9:]
+    elif words[1].startswith("smooth="):
+        try:
+            smoothWeight = float(words[1][7:])
+            if smoothWeight<0.:
+                raise ValueError
+        except ValueError:
+            print("smooth requires a number >= 0")
+            smoothWeight = 1.0
+    elif name in SOLVER_OPTIONS and "=" in words[1]:
+        setSolverOption(name,words[1].split("=",1)[1])
+    elif words[1] in ("engine=numba","engine=numpy"):
+        engineChoice=words[1][7:]
+        if engineChoice=="numba" and not cu.haveNumba:
+            print("numba not available, using numpy")
+            engineChoice="numpy"
     else:
         print("Option not recognised")
        
 
+def cacheCommand(words):
+    """ Manage the cache of fit results used by fitatt.
+        Syntax: cache stats|clear
+        stats reports the entries and size of the cache, clear removes all entries.
+        The cache is enabled with "setoptions cache=on" and limited in size by
+        "setoptions cachesize=MB"; the least recently used results are removed first.
+    """
+    if len(words) != 2 or words[1] not in ("stats","clear"):
+        print("syntax: cache stats|clear")
+        return
+    store = resultStore
+    if store is None:
+        store = cu.resultCache(CACHE_DIR,cacheMBytes*2**20)
+    if words[1] == "clear":
+        print("removed ",store.clear()," cached results from ",store.directory)
+        return
+    count,nbytes,hits,misses = store.stats()
+    print("cache ",store.directory,": ",count," results, ",
+          '{0:.2f}'.format(nbytes/2.**20)," MB of ",cacheMBytes," MB")
+    print("hits = ",hits," misses = ",misses," (this session)")
+    if resultStore is None:
+        print("cache is off")
+
+
+def setSolverOption(name,value):
+    """ Check and store the value of solver control "name" in solverOptions,
+        or remove it if value is "default".
+    """
+    if value=="default":
+        solverOptions.pop(name,None)
+        return
+    try:
+        if name in ("ftol","xtol","gtol","diff_step"):
+            val = float(value)
+            if val<=0.:
+                raise ValueError
+        elif name in ("max_nfev","verbose"):
+            val = int(value)
+            if val<0 or (name=="max_nfev" and val==0):
+                raise ValueError
+        elif name=="x_scale":
+            if value=="jac":
+                val = value
+            else:
+                val = [float(v) for v in value.split(",")]
+                if min(val)<=0.:
+                    raise ValueError
+                if len(val)==1:
+                    val = val[0]
+        else:
+            if value not in SOLVER_OPTIONS[name]:
+                raise ValueError
+            val = value
+    except ValueError:
+        print("Bad value for ",name,"; allowed: ",", ".join(SOLVER_OPTIONS[name]))
+        return
+    solverOptions[name] = val
+
+def showTrace(words):
+    """ Show the trace of the solver evaluations in the last fit: elapsed time,
+        cost and norm of the step from the best point found so far.
+        Syntax: showtrace [all] [plot]
+        By default only the evaluations that improved the cost, i.e. the
+        iterations, are listed; "all" lists every evaluation, "plot" plots
+        the cost against evaluation number.
+    """
+    if not 'fit' in globals() or len(fit.trace)==0:
+        print("no fit trace available")
+        return
+    trace = fit.trace
+    showAll = "all" in words[1:]
+    print("  eval      time         cost         step")
+    for i,(tim,cost,step,improved) in enumerate(trace):
+        if showAll or improved:
+            print('{0:6d} {1:9.3f} {2:12.5e} {3:12.5e}{4}'.format(i,tim,cost,step,"" if improved else " x"))
+    print("evaluations: ",len(trace)," improved: ",sum(1 for t in trace if t[3]))
+    if "plot" in words[1:]:
+        try:
+            plt.figure(FIG_TRACE)
+            cost = np.array([t[1] for t in trace])
+            plt.semilogy(cost,'.',label='all')
+            best = [i for i in range(len(trace)) if trace[i][3]]
+            plt.semilogy(best,cost[best],'-',label='improved')
+            plt.xlabel('evaluation')
+            plt.ylabel('cost')
+            plt.legend()
+            plt.draw()
+            plt.show(block=False)
+        except:
+            print("Plotting failed")
+
 def checkVersions():
     """ Check version of matplotlib and exit if too old
     """
@@ -754,6 +1506,7 @@ cmd_switch = { "load":loadAll,
                "setfilter":setFilter,
                "setwidth":setWidth,
                "fitatt":fitAtt,
+               "refit":refit,
                "initguess":initGuess,
                "vary":setVary,
                "setcormat":setCorMat,
@@ -763,6 +1516,13 @@ cmd_switch = { "load":loadAll,
                "help":helpCar,
                "transform":transform,
                "setoptions":setOptions,
+               "mergefits":mergeFits,
+               "compareres":compareResidual,
+               "showtrace":showTrace,
+               "fitstatus":fitStatus,
+               "fitcancel":fitCancel,
+               "fitwait":fitWait,
+               "cache":cacheCommand,
                }
 
 # set figures to use for different plots
@@ -772,6 +1532,16 @@ FIG_SPEC = "Spectra"
 FIG_IMG = "CarouselImages"
 FIG_ERR = "ErrorInFit"
 FIG_ATTCOMP = "ObservedVsFittedAtten"
+FIG_TRACE = "SolverTrace"
+# directory of the fit result cache, see setoptions cache
+CACHE_DIR = ".bhc_cache"
+# solver controls that can be set with setoptions, and allowed values where
+# these are a list of names
+SOLVER_OPTIONS = { "ftol":["number>0"], "xtol":["number>0"], "gtol":["number>0"],
+                   "max_nfev":["integer>0"], "x_scale":["jac","number(s)>0"],
+                   "diff_step":["number>0"], "verbose":["0","1","2"],
+                   "loss":["linear","soft_l1","huber","cauchy","arctan"],
+                   "tr_solver":["exact","lsmr"] }
 # simple command line loop to allow loading of data and run
 # of fitting code.
 
@@ -805,12 +1575,42 @@ if __name__ == "__main__":
     vary[3:] = -1
     # set the default solver type to be "old"
     solverChoice = "old"
+    # use finite difference Jacobian by default
+    jacChoice = "numeric"
+    jacThreads = 0
+    # evaluate model on full energy grid by default
+    energyBins = 0
+    # forward model evaluated with numpy by default
+    engineChoice = "numpy"
+    # fit polynomials in line number by default, see setoptions linemode
+    lineMode = "poly"
+    smoothWeight = 1.0
+    # legacy squared residuals by default, see setoptions residual
+    residualChoice = "squared"
+    # solver controls, see setoptions; scipy defaults if not set
+    solverOptions = {}
+    # fits run in the foreground unless background=on; backgroundJob is the
+    # fit running on a worker thread, if any
+    backgroundChoice = "off"
+    backgroundJob = None
+    # no checkpoints of fits unless set, see setoptions checkpoint
+    checkpointEvals = 0
+    checkpointSeconds = 0.
+    # arguments of the last fitatt, repeated by refit, and the last fit completed,
+    # from which refit starts
+    lastFitArgs = None
+    lastFit = None
+    # repeated fits are taken from the result cache by default
+    cacheMBytes = 500.
+    resultStore = cu.resultCache(CACHE_DIR,cacheMBytes*2**20)
     # set an object for the material to which attenuation is to be corrected to;
     # this is null until the user provides one
     corMat = cu.materialAtt("",1.0)
     # command loop
     filein = False
     while True:
+        # report a background fit that has finished
+        completeBackground(False)
         try:
             if filein:
                 cmd = infile.readline().strip()
@@ -828,7 +1628,11 @@ if __name__ == "__main__":
         except EOFError as ex:
             logging.info('bhc: EOF')
             print("EOF")
+            completeBackground(True)
             sys.exit(0)
+        except KeyboardInterrupt:
+            print("")
+            continue
         logging.info('bhc: '+cmd)
         words = cmd.split(" ")
         try:
@@ -848,6 +1652,12 @@ if __name__ == "__main__":
                 cmd_switch[words[0]](words)
         except SystemExit as ex:
             sys.exit(0)
+        except KeyboardInterrupt:
+            # keep the session and loaded data; stop reading any script file
+            print("** interrupted")
+            if filein:
+                filein = False
+                infile.close()
         except KeyError as ex:
             if not ( words[0] == "" ):
                 print("** command not found: ", words[0])